@@ -0,0 +1,69 @@
+import asyncio
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+from fastapi import HTTPException
+from instagrapi import Client
+
+from executor import executor
+from ratelimit import RateLimited
+from storages import ClientStorage, session_key
+
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+
+
+def parse_items(values: Iterable[str]) -> List[str]:
+    """Split repeated and comma/space separated form values, drop duplicates
+    """
+    items = {}
+    for value in values:
+        for item in re.split(r'[\s,]+', value):
+            if item:
+                items[item] = None
+    return list(items)
+
+
+async def fan_out(clients: ClientStorage, sessionid: str, proxy: str, items: List[str],
+                  call: Callable[[Client, int, str], Awaitable[Any]],
+                  concurrency: int = BATCH_CONCURRENCY) -> Dict:
+    """Run call(cl, lane, item) for every item over a bounded set of lanes
+
+    Lane 0 uses the warm pooled Client, other lanes use copies built from the
+    same stored settings, so a Client is still never shared between threads.
+    Returns partial results with per-item errors. Only cache misses go
+    upstream, paced by the session's live rate limit bucket; misses past its
+    max wait fail alone with RateLimited (and retry_after) while the other
+    items still complete.
+    """
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f'Batch is limited to {BATCH_MAX_ITEMS} items')
+    proxy = ClientStorage.proxies.resolve(proxy, session_key(sessionid))
+    results, errors = {}, {}
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def worker(lane: int):
+        cl = None
+        while not queue.empty():
+            item = queue.get_nowait()
+            try:
+                if cl is None:
+                    if lane == 0:
+                        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+                    else:
+                        cl = await executor.run_lane(sessionid, lane, clients.build, session_key(sessionid), proxy)
+                results[item] = await call(cl, lane, item)
+            except Exception as e:
+                errors[item] = {
+                    "detail": str(e),
+                    "exc_type": str(type(e).__name__)
+                }
+                if isinstance(e, RateLimited):
+                    errors[item]["retry_after"] = int(e.retry_after) + 1
+
+    lanes = max(1, min(concurrency, len(items)))
+    await asyncio.gather(*[worker(lane) for lane in range(lanes)])
+    return {'results': {item: results[item] for item in items if item in results}, 'errors': errors}
@@ -0,0 +1,209 @@
+import argparse
+import base64
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from Cryptodome.PublicKey import RSA
+from requests.adapters import HTTPAdapter
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+MOCK_HOST_HEADER = 'X-Mock-Host'
+API_HOST = 'i.instagram.com'
+
+
+class Fixture:
+    """Recorded response for METHOD host path, path placeholders {name} and a trailing * become ${name} in it
+    """
+
+    def __init__(self, method: str, host: str, path: str, status: int = 200, headers: Optional[Dict] = None,
+                 body=None, size: int = 0, latency: Optional[float] = None):
+        self.method = method
+        self.host = host
+        self.pattern = re.compile('^' + re.sub(r'\\\{(\w+)\\\}', r'(?P<\1>[^/]+)', re.escape(path))
+                                  .replace(r'\*', '(?P<rest>.*)') + '$')
+        self.status = status
+        self.headers = headers or {}
+        self.body = Template(json.dumps(body)) if body is not None else None
+        self.payload = os.urandom(size)
+        self.latency = latency
+
+    def match(self, method: str, host: str, path: str) -> Optional[Dict[str, str]]:
+        if method != self.method or not host.endswith(self.host):
+            return None
+        match = self.pattern.match(path)
+        return match.groupdict() if match else None
+
+    def render(self, values: Dict[str, str]) -> Tuple[Dict[str, str], bytes]:
+        headers = {name: Template(value).safe_substitute(values) for name, value in self.headers.items()}
+        if self.body is None:
+            return headers, self.payload
+        headers.setdefault('Content-Type', 'application/json')
+        return headers, self.body.safe_substitute(values).encode()
+
+
+def load_fixtures(folder: str = FIXTURES_DIR) -> List[Fixture]:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        with open(path) as fp:
+            for item in json.load(fp):
+                fixtures.append(Fixture(item['method'], item['host'], item['path'], item.get('status', 200),
+                                        item.get('headers'), item.get('body'), item.get('bytes', 0),
+                                        item.get('latency')))
+    return fixtures
+
+
+class MockInstagram(ThreadingHTTPServer):
+    """Replay fixtures as the private API, the public web API and the CDN
+
+    The original host comes in the X-Mock-Host header (see RewriteAdapter).
+    Every response waits latency seconds (+-jitter share, or the fixture's own
+    latency); error_rate of them fail with a random status of error_statuses.
+    Unmatched private API calls answer {"status": "ok"}, everything else 404,
+    so instagrapi falls back from its public to its private methods.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int] = ('127.0.0.1', 0), fixtures: Optional[List[Fixture]] = None,
+                 latency: float = 0.0, jitter: float = 0.2, error_rate: float = 0.0,
+                 error_statuses: Sequence[int] = (429, 500)):
+        super().__init__(address, MockHandler)
+        self.fixtures = load_fixtures() if fixtures is None else fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        key = RSA.generate(1024)
+        self.public_key = base64.b64encode(key.publickey().export_key()).decode()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def respond(self, method: str, host: str, path: str) -> Tuple[int, Dict[str, str], bytes, float]:
+        with self._lock:
+            self.requests += 1
+        delay = self.latency
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            status = random.choice(self.error_statuses)
+            body = {'message': 'Please wait a few minutes before you try again.' if status == 429 else 'error',
+                    'status': 'fail'}
+            return status, {'Content-Type': 'application/json'}, json.dumps(body).encode(), delay
+        for fixture in self.fixtures:
+            values = fixture.match(method, host, path)
+            if values is None:
+                continue
+            if fixture.latency is not None:
+                delay = fixture.latency
+            headers, body = fixture.render(dict(values, **self.session_values()))
+            return fixture.status, headers, body, delay
+        if host == API_HOST:
+            return 200, {'Content-Type': 'application/json'}, b'{"status": "ok"}', delay
+        return 404, {'Content-Type': 'application/json'}, b'{"status": "fail", "message": "Not found"}', delay
+
+    def session_values(self) -> Dict[str, str]:
+        """Fresh login values for ${sessionid}, ${ds_user_id} and ${authorization}
+        """
+        user_id = str(random.randint(10 ** 9, 10 ** 10))
+        sessionid = '%s%%3A%s%%3A1' % (user_id, uuid.uuid4().hex[:14])
+        authorization = base64.b64encode(json.dumps({'ds_user_id': user_id, 'sessionid': sessionid}).encode())
+        return {'sessionid': sessionid, 'ds_user_id': user_id, 'authorization': authorization.decode(),
+                'public_key': self.public_key}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        host = self.headers.get(MOCK_HOST_HEADER) or (self.headers.get('Host') or '').split(':')[0]
+        status, headers, body, delay = self.server.respond(self.command, host, urlsplit(self.path).path)
+        if delay:
+            time.sleep(max(0.0, delay * random.uniform(1 - self.server.jitter, 1 + self.server.jitter)))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class RewriteAdapter(HTTPAdapter):
+    """Send every request to the mock server, the original host goes in X-Mock-Host
+    """
+
+    def __init__(self, target: str, **kwargs):
+        super().__init__(**kwargs)
+        self.target = urlsplit(target)
+
+    def send(self, request, **kwargs):
+        request = request.copy()  # cookies are stored for the original host
+        url = urlsplit(request.url)
+        request.headers[MOCK_HOST_HEADER] = url.hostname
+        request.url = urlunsplit((self.target.scheme, self.target.netloc, url.path, url.query, ''))
+        kwargs['proxies'] = {}
+        return super().send(request, **kwargs)
+
+
+@contextmanager
+def mocked_upstream(target: str) -> Iterator[RewriteAdapter]:
+    """Route every requests.Session (instagrapi Clients, CDN downloads, requests.get) to target
+    """
+    adapter = RewriteAdapter(target, pool_connections=10, pool_maxsize=64)
+    original = requests.Session.get_adapter
+    requests.Session.get_adapter = lambda session, url: adapter
+    try:
+        yield adapter
+    finally:
+        requests.Session.get_adapter = original
+        adapter.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Replay recorded Instagram responses with latency and errors')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--jitter', type=float, default=0.2, help='latency varies by this share')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failed responses')
+    parser.add_argument('--error-status', default='429,500', help='statuses of failed responses')
+    args = parser.parse_args(argv)
+    server = MockInstagram((args.host, args.port), load_fixtures(args.fixtures), args.latency, args.jitter,
+                           args.error_rate, [int(status) for status in args.error_status.split(',')])
+    print(f'Listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
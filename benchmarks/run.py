@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+PROXY = 'http://bench-proxy:3128'
+MEDIA_PK = 2110901750722920960
+
+
+class Context(NamedTuple):
+    sessions: List[str]
+    proxy: str
+    photo: bytes
+    run: int = 0  # every run asks for other pks and tags, so it starts with cold caches
+
+    def pk(self, base: int, i: int) -> str:
+        return str(base + self.run * 10 ** 5 + i)
+
+
+class Scenario(NamedTuple):
+    run: Callable[..., Awaitable[bool]]
+    requests: int  # default request count, slow scenarios run fewer
+
+
+async def post(ac, path: str, data: Dict, **kwargs):
+    response = await ac.post(path, data=data, **kwargs)
+    return response.status_code < 400, response
+
+
+async def auth(ac, ctx: Context, i: int) -> bool:
+    ok, _ = await post(ac, '/auth/login', {'username': f'bench{i}', 'password': 'secret', 'proxy': ctx.proxy})
+    return ok
+
+
+async def user(ac, ctx: Context, i: int) -> bool:
+    ok, _ = await post(ac, '/user/info', {'sessionid': ctx.sessions[i % len(ctx.sessions)], 'proxy': ctx.proxy,
+                                          'user_id': ctx.pk(10 ** 6, i), 'use_cache': 'false'})
+    return ok
+
+
+async def media(ac, ctx: Context, i: int) -> bool:
+    ok, _ = await post(ac, '/media/info', {'sessionid': ctx.sessions[i % len(ctx.sessions)], 'proxy': ctx.proxy,
+                                           'pk': ctx.pk(MEDIA_PK, i), 'use_cache': 'false'})
+    return ok
+
+
+async def download(ac, ctx: Context, i: int) -> bool:
+    ok, _ = await post(ac, '/download/download_photo_by_pk', {
+        'sessionid': ctx.sessions[i % len(ctx.sessions)], 'proxy': ctx.proxy, 'media_pk': ctx.pk(MEDIA_PK, i)})
+    return ok
+
+
+async def hashtag(ac, ctx: Context, i: int) -> bool:
+    ok, _ = await post(ac, '/hashtag/get_hashtag_info', {
+        'sessionid': ctx.sessions[i % len(ctx.sessions)], 'proxy': ctx.proxy, 'name': f'tag{ctx.run}x{i % 50}'})
+    return ok
+
+
+async def upload(ac, ctx: Context, i: int) -> bool:
+    """Submit a photo upload job and wait until it is done
+    """
+    ok, response = await post(ac, '/jobs/submit', {
+        'sessionid': ctx.sessions[i % len(ctx.sessions)], 'proxy': ctx.proxy, 'kind': 'photo_upload',
+        'params': json.dumps({'caption': f'bench {i}'})}, files={'file': ('photo.jpg', ctx.photo, 'image/jpeg')})
+    if not ok:
+        return False
+    job_id = response.json()['id']
+    while True:
+        status = (await ac.get(f'/jobs/{job_id}')).json()
+        if status['state'] in ('done', 'failed'):
+            return status['state'] == 'done'
+        await asyncio.sleep(0.05)
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    'auth': Scenario(auth, 100),
+    'user': Scenario(user, 200),
+    'media': Scenario(media, 200),
+    'download': Scenario(download, 200),
+    'hashtag': Scenario(hashtag, 200),
+    'upload': Scenario(upload, 16),  # instagrapi waits 3 s before configuring every upload
+}
+
+
+def prepare_env(workdir: str):
+    """Throwaway stores, a pool big enough for every session, rate limits out of the way unless set explicitly
+    """
+    defaults = {
+        'SESSION_DB': os.path.join(workdir, 'sessions.sqlite3'),
+        'JOB_DIR': os.path.join(workdir, 'jobs'),
+        'JOB_WORKERS': '64',
+        'JOB_POLL_INTERVAL': '0.05',
+        'CLIENT_POOL_MAX_SIZE': '4096',  # login scenarios must not evict the warm benchmark sessions
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media_cache'),
+        'RENDER_CACHE_DIR': os.path.join(workdir, 'render_cache'),
+        'RATE_LIMIT_SESSION_RATE': '1e9',
+        'RATE_LIMIT_SESSION_BURST': '1e9',
+        'RATE_LIMIT_PROXY_RATE': '1e9',
+        'RATE_LIMIT_PROXY_BURST': '1e9',
+        'RATE_LIMIT_MAX_RATE': '1e9',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def sample_photo() -> bytes:
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (1080, 1080), (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))] if ordered else 0.0
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+async def drive(ac, scenario: Scenario, ctx: Context, requests: int, concurrency: int) -> Dict:
+    """Run requests calls, concurrency at a time
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                ok = await scenario.run(ac, ctx, i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(requests / seconds, 2),
+        'p50': round(percentile(latencies, 0.5), 4),
+        'p99': round(percentile(latencies, 0.99), 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def start_mock(args) -> Tuple[subprocess.Popen, str]:
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.mockserver', '--latency', str(args.latency),
+         '--error-rate', str(args.error_rate), '--error-status', args.error_status],
+        cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise RuntimeError('Mock server did not start')
+    return process, line.split()[-1]
+
+
+async def benchmark(args, target: str) -> Dict[str, Dict]:
+    from httpx import AsyncClient
+
+    from benchmarks.mockserver import mocked_upstream
+    from main import app
+
+    results = {}
+    with mocked_upstream(target):
+        await app.router.startup()
+        try:
+            async with AsyncClient(app=app, base_url='http://bench', timeout=None) as ac:
+                sessions = []
+                for i in range(max(args.concurrency)):
+                    response = await ac.post('/auth/login', data={
+                        'username': f'session{i}', 'password': 'secret', 'proxy': PROXY})
+                    response.raise_for_status()
+                    sessions.append(response.json())
+                ctx = Context(sessions, PROXY, sample_photo())
+                for name in args.scenarios:
+                    scenario = SCENARIOS[name]
+                    for concurrency in args.concurrency:
+                        key = f'{name}@{concurrency}'
+                        ctx = ctx._replace(run=len(results))
+                        results[key] = await drive(ac, scenario, ctx, args.requests or scenario.requests,
+                                                   concurrency)
+                        print(format_result(key, results[key]), flush=True)
+        finally:
+            await app.router.shutdown()
+    return results
+
+
+def format_result(key: str, result: Dict) -> str:
+    return ('%-14s %8.1f req/s  p50 %7.1f ms  p99 %7.1f ms  rss %6.1f MB  errors %d/%d' % (
+        key, result['throughput'], result['p50'] * 1000, result['p99'] * 1000, result['peak_rss_mb'],
+        result['errors'], result['requests']))
+
+
+def regressions(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Results worse than the baseline by more than tolerance (share)
+    """
+    found = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            found.append(f"{key}: throughput {result['throughput']} < {base['throughput']} req/s")
+        for metric in ('p50', 'p99', 'peak_rss_mb'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                found.append(f'{key}: {metric} {result[metric]} > {base[metric]}')
+        if result['errors'] > base['errors']:
+            found.append(f"{key}: errors {result['errors']} > {base['errors']}")
+    return found
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the API against the local mock Instagram server')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated levels')
+    parser.add_argument('--requests', type=int, default=0, help='per scenario and level (default: scenario own)')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock upstream seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', default='429,500')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed share of regression')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    prepare_env(workdir)
+    sys.path.insert(0, ROOT)
+    mock, target = start_mock(args)
+    try:
+        results = asyncio.get_event_loop().run_until_complete(benchmark(args, target))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as fp:
+                baseline = json.load(fp)
+        baseline.update(results)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        print(f'Baseline updated: {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as fp:
+        found = regressions(results, json.load(fp), args.tolerance)
+    for line in found:
+        print(f'REGRESSION {line}')
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTLS = {
+    'user': float(os.environ.get('RESPONSE_CACHE_TTL_USER', 300)),
+    'media': float(os.environ.get('RESPONSE_CACHE_TTL_MEDIA', 600)),
+    'story': float(os.environ.get('RESPONSE_CACHE_TTL_STORY', 120)),
+    'hashtag': float(os.environ.get('RESPONSE_CACHE_TTL_HASHTAG', 600)),
+}
+CACHE_STALE_TTL = float(os.environ.get('RESPONSE_CACHE_STALE_TTL', 600))
+CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_DEFAULT_TTL = 60.0
+
+
+def estimate_size(value: Any) -> int:
+    """Approximate memory of cached value by its JSON size
+    """
+    if hasattr(value, 'json'):
+        return len(value.json())
+    return len(json.dumps(value, default=str))
+
+
+def shared_key(kind: str, key: Hashable) -> str:
+    """Key of a cache entry in shared state
+    """
+    return f'cache:{kind}:{key!r}'
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent identical requests
+
+    All callers awaiting the same key get the leader's result or its error.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+        else:
+            self.leaders += 1
+            future = self._calls[key] = asyncio.ensure_future(fetch())
+            future.add_done_callback(lambda f: self._done(key, f))
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # retrieved even if every waiter went away
+
+    def stats(self) -> Dict:
+        """Coalescing counters
+        """
+        calls = self.leaders + self.shared
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'shared_ratio': self.shared / calls if calls else 0.0,
+        }
+
+
+class ResponseCache:
+    """Process-wide TTL cache of public objects keyed by (kind, key)
+
+    Entries are fresh for the kind's TTL, then served stale for stale_ttl
+    more seconds while a background refresh runs. Total size is capped at
+    max_bytes with LRU eviction. Concurrent misses of one key share a fetch.
+    With shared set (a SharedState, see serve.py), stored values also go
+    there and misses look there before fetching, so workers share entries.
+    """
+
+    def __init__(self, ttls: Dict[str, float] = CACHE_TTLS, stale_ttl: float = CACHE_STALE_TTL,
+                 max_bytes: int = CACHE_MAX_BYTES, flights: Optional[SingleFlight] = None):
+        self.flights = flights or SingleFlight()
+        self.ttls = dict(ttls)
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared = None
+        self.shared_hits = 0
+        self._items: 'OrderedDict[Tuple[str, Hashable], Tuple[Any, int, float, float]]' = OrderedDict()
+        self._refreshing: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, kind: str, key: Hashable) -> Tuple[Optional[Any], Optional[str]]:
+        """Get (value, 'fresh' | 'stale') or (None, None), counts hits/misses
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get((kind, key))
+            if item is not None and now > item[3]:
+                self._remove((kind, key))
+                item = None
+            if item is None:
+                self.misses += 1
+                return None, None
+            self._items.move_to_end((kind, key))
+            if now <= item[2]:
+                self.hits += 1
+                return item[0], 'fresh'
+            self.stale_hits += 1
+            return item[0], 'stale'
+
+    def set(self, kind: str, key: Hashable, value: Any, ttl: Optional[float] = None):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        fresh_until = time.monotonic() + (self.ttls.get(kind, CACHE_DEFAULT_TTL) if ttl is None else ttl)
+        with self._lock:
+            if (kind, key) in self._items:
+                self._remove((kind, key))
+            self._items[(kind, key)] = (value, size, fresh_until, fresh_until + self.stale_ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, item_key: Tuple[str, Hashable]):
+        _, size, _, _ = self._items.pop(item_key)
+        self.size -= size
+
+    async def _store(self, kind: str, key: Hashable, value: Any):
+        """Set value here and in shared state (fresh for the kind's TTL there too)
+        """
+        self.set(kind, key, value)
+        if self.shared is not None:
+            ttl = self.ttls.get(kind, CACHE_DEFAULT_TTL)
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.shared.set, shared_key(kind, key), (value, time.time() + ttl), ttl + self.stale_ttl)
+
+    async def _lookup_shared(self, kind: str, key: Hashable) -> Optional[Any]:
+        """Fresh value another worker stored, copied to this process
+        """
+        item = await asyncio.get_event_loop().run_in_executor(None, self.shared.get, shared_key(kind, key))
+        if item is None:
+            return None
+        value, fresh_until = item
+        remaining = fresh_until - time.time()
+        if remaining <= 0:
+            return None
+        self.shared_hits += 1
+        self.set(kind, key, value, ttl=remaining)
+        return value
+
+    def _revalidate(self, kind: str, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        if (kind, key) in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._store(kind, key, await fetch())
+            except Exception as e:
+                logger.warning('Revalidation of %s %s failed: %r', kind, key, e)
+            finally:
+                self._refreshing.pop((kind, key), None)
+
+        self._refreshing[(kind, key)] = asyncio.ensure_future(refresh())
+
+    async def get_or_fetch(self, kind: str, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                           refresh: bool = False) -> Any:
+        """Return cached value or await fetch() and cache it
+
+        refresh=True skips the lookup (e.g. use_cache=False) but still stores the result.
+        """
+        if not refresh:
+            value, state = self.lookup(kind, key)
+            if state == 'fresh':
+                return value
+            if state == 'stale':
+                self._revalidate(kind, key, fetch)
+                return value
+        async def fetch_and_store():
+            if self.shared is not None and not refresh:
+                value = await self._lookup_shared(kind, key)
+                if value is not None:
+                    return value
+            value = await fetch()
+            await self._store(kind, key, value)
+            return value
+
+        return await self.flights.do((kind, key, refresh), fetch_and_store)
+
+    def stats(self) -> Dict:
+        """Cache counters
+        """
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._items),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'ttls': self.ttls,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'evictions': self.evictions,
+                'refreshing': len(self._refreshing),
+                'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
+
+
+flights = SingleFlight()
+response_cache = ResponseCache(flights=flights)
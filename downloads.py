@@ -0,0 +1,152 @@
+import asyncio
+import io
+import os
+import time
+import zipfile
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from instagrapi import Client
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+from proxies import proxy_pool
+
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', 30))
+DOWNLOAD_VERIFY_TLS = os.environ.get('DOWNLOAD_VERIFY_TLS', '1') == '1'  # 0 skips CDN certificate checks
+
+PASS_HEADERS = ('Content-Length', 'Content-Range', 'Content-Type', 'Content-Encoding', 'Accept-Ranges',
+                'Last-Modified', 'ETag')
+
+
+def media_url(media) -> str:
+    """CDN URL of Media or Story (video if any, else photo)
+    """
+    url = getattr(media, 'video_url', None) or media.thumbnail_url
+    if not url:
+        raise Exception(f'Media {media.pk} has no downloadable resource')
+    return str(url)
+
+
+def open_upstream(cl: Client, url: str, range_header: Optional[str] = None) -> requests.Response:
+    """Open CDN response for streaming via the client's proxy, on its shared keep-alive connections (blocking)
+    """
+    headers = {'User-Agent': cl.public.headers.get('User-Agent', '')}
+    if range_header:
+        headers['Range'] = range_header
+    session = proxy_pool.session(getattr(cl, 'proxy', None))
+    response = session.get(url, headers=headers, proxies=cl.public.proxies, stream=True,
+                           timeout=DOWNLOAD_TIMEOUT, verify=DOWNLOAD_VERIFY_TLS)
+    if response.status_code >= 400:
+        response.close()
+        response.raise_for_status()
+    return response
+
+
+def album_entries(media) -> List[Tuple[str, str]]:
+    """(filename, CDN URL) of every album resource, named like cl.album_download does
+    """
+    if media.media_type != 8:
+        raise Exception(f'Media {media.pk} is not an album')
+    entries = []
+    for resource in media.resources:
+        ext = 'mp4' if resource.media_type == 2 else 'jpg'
+        entries.append((f'{media.user.username}_{resource.pk}.{ext}', media_url(resource)))
+    return entries
+
+
+def url_entries(urls: List[str]) -> List[Tuple[str, str]]:
+    """(filename, URL) named by the last URL path part, prefixed by position when names clash
+    """
+    names = [os.path.basename(urlparse(url).path) or 'file' for url in urls]
+    return [
+        (name if names.count(name) == 1 else f'{i}_{name}', url)
+        for i, (name, url) in enumerate(zip(names, urls))
+    ]
+
+
+def iter_upstream(response: requests.Response, decode_content: bool = False) -> Iterator[bytes]:
+    try:
+        yield from response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=decode_content)
+    finally:
+        response.close()
+
+
+async def stream_download(cl: Client, url: str, range_header: Optional[str] = None,
+                          filename: Optional[str] = None) -> StreamingResponse:
+    """Stream CDN file to the client in chunks, never touching local disk
+
+    Content-Length and Range (206 / Content-Range) are passed through.
+    """
+    upstream = await run_in_threadpool(open_upstream, cl, url, range_header)
+    headers: Dict[str, str] = {name: upstream.headers[name] for name in PASS_HEADERS if name in upstream.headers}
+    headers.setdefault('Accept-Ranges', 'bytes')
+    filename = filename or os.path.basename(urlparse(url).path)
+    if filename:
+        headers['Content-Disposition'] = f'inline; filename="{filename}"'
+    media_type = headers.pop('Content-Type', None) or 'application/octet-stream'
+    return StreamingResponse(iter_upstream(upstream), status_code=upstream.status_code,
+                             headers=headers, media_type=media_type)
+
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable file for ZipFile, collects written bytes until drained
+
+    ZipFile falls back to data descriptors when it cannot seek back, so
+    entries can be written without knowing their size or CRC up front.
+    """
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> List[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip(entries: List[Tuple[str, requests.Response]]) -> Iterator[bytes]:
+    """Build a ZIP of stored (uncompressed) entries while the upstream bodies are read
+    """
+    sink = _ZipSink()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            for name, upstream in entries:
+                info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                info.file_size = int(upstream.headers.get('Content-Length') or 0)
+                with archive.open(info, 'w') as fp:
+                    for chunk in iter_upstream(upstream, decode_content=True):
+                        fp.write(chunk)
+                        yield from sink.drain()
+                yield from sink.drain()
+        yield from sink.drain()
+    finally:
+        for _, upstream in entries:
+            upstream.close()
+
+
+async def stream_zip(cl: Client, entries: List[Tuple[str, str]], filename: str) -> StreamingResponse:
+    """Stream (filename, URL) entries as one ZIP built on the fly
+
+    All upstream requests are opened concurrently, bodies are then copied
+    into the archive in order, one chunk at a time.
+    """
+    opened = await asyncio.gather(*[run_in_threadpool(open_upstream, cl, url) for _, url in entries],
+                                  return_exceptions=True)
+    errors = [upstream for upstream in opened if isinstance(upstream, BaseException)]
+    if errors:
+        for upstream in opened:
+            if not isinstance(upstream, BaseException):
+                upstream.close()
+        raise errors[0]
+    names = [name for name, _ in entries]
+    return StreamingResponse(iter_zip(list(zip(names, opened))), media_type='application/zip',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from instagrapi import Client
+
+from metrics import errors, upstream_latency
+from profiling import annotate, record_phase, traced
+from proxies import proxy_pool
+from ratelimit import RateLimiter, limiter
+from storages import ClientStorage, session_key
+from validation import LOGIN_ERRORS
+
+EXECUTOR_WORKERS = int(os.environ.get('EXECUTOR_WORKERS', 32))
+EXECUTOR_QUEUE_SIZE = int(os.environ.get('EXECUTOR_QUEUE_SIZE', 256))
+EXECUTOR_QUEUE_TIMEOUT = float(os.environ.get('EXECUTOR_QUEUE_TIMEOUT', 30))
+EXECUTOR_SESSION_QUEUE_SIZE = int(os.environ.get('EXECUTOR_SESSION_QUEUE_SIZE', 32))
+
+
+class ExecutorSaturated(Exception):
+    """All executor slots stay busy longer than EXECUTOR_QUEUE_TIMEOUT, or a session queued too many calls
+    """
+
+
+def upstream_client(fn: Callable, args: Sequence) -> Optional[Client]:
+    """Client a call goes upstream with: bound Client method or page function taking the Client first
+    """
+    owner = getattr(fn, '__self__', None)
+    if isinstance(owner, Client):
+        return owner
+    if args and isinstance(args[0], Client):
+        return args[0]
+    return None
+
+
+class SessionExecutor:
+    """Run blocking instagrapi calls in a bounded thread pool
+
+    Calls of one sessionid are serialized (a Client is never used from two
+    threads at once), calls of different sessions overlap. A login/challenge
+    error invalidates the session (see ClientStorage.invalidate). Each
+    session queues at most session_queue_size calls behind its running one,
+    more fail with ExecutorSaturated at once. A call takes one of the
+    workers + queue_size global slots only once it is next in its session
+    and paced by the rate limiter (calls going upstream through a Client),
+    so a busy session cannot hold slots other sessions could use; it fails
+    with ExecutorSaturated when no slot frees up within queue_timeout.
+    """
+
+    def __init__(self, workers: int = EXECUTOR_WORKERS, queue_size: int = EXECUTOR_QUEUE_SIZE,
+                 queue_timeout: float = EXECUTOR_QUEUE_TIMEOUT, rate_limiter: Optional[RateLimiter] = None,
+                 session_queue_size: int = EXECUTOR_SESSION_QUEUE_SIZE):
+        self.workers = workers
+        self.limiter = rate_limiter or limiter
+        self.capacity = workers + queue_size
+        self.queue_timeout = queue_timeout
+        self.session_queue_size = session_queue_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='instagrapi')
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+        self._slots = None
+        self._pending: Dict[Tuple[str, int], int] = {}
+        self._locks: 'weakref.WeakValueDictionary[Tuple[str, int], asyncio.Lock]' = weakref.WeakValueDictionary()
+
+    def _lock(self, key: Tuple[str, int]) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def _acquire_slot(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ExecutorSaturated(f'Executor is saturated ({self.capacity} calls in flight), retry later')
+
+    async def run(self, sessionid: str, fn: Callable, *args, **kwargs):
+        """Run fn(*args, **kwargs) in the pool, serialized per sessionid
+        """
+        return await self.run_lane(sessionid, 0, fn, *args, **kwargs)
+
+    async def run_lane(self, sessionid: str, lane: int, fn: Callable, *args, **kwargs):
+        """Run fn in the pool, serialized per (sessionid, lane)
+
+        Lanes let batch requests of one session drive several Client copies.
+        """
+        queued = time.monotonic()
+        key = session_key(sessionid)
+        lane_key = (key, lane)
+        pending = self._pending.get(lane_key, 0)
+        if pending > self.session_queue_size:
+            self.rejected += 1
+            raise ExecutorSaturated(f'Session has {pending - 1} calls queued already, retry later')
+        self._pending[lane_key] = pending + 1
+        self.queued += 1
+        dequeued = False
+        try:
+            cl = upstream_client(fn, args)
+            name = getattr(fn, '__name__', 'call')
+            annotate(key, getattr(cl, 'proxy', None))
+            async with self._lock(lane_key):
+                record_phase('executor_wait', time.monotonic() - queued)
+                if cl is not None:
+                    wait = await self.limiter.reserve_async(key, cl.proxy)
+                    if wait:
+                        record_phase('ratelimit_wait', wait)
+                    await asyncio.sleep(wait)
+                admission = time.monotonic()
+                await self._acquire_slot()
+                record_phase('executor_wait', time.monotonic() - admission)
+                self.queued -= 1
+                dequeued = True
+                self.running += 1
+                started = time.monotonic()
+                error = None
+                try:
+                    loop = asyncio.get_event_loop()
+                    return await loop.run_in_executor(self.pool, traced(partial(fn, *args, **kwargs)))
+                except LOGIN_ERRORS as e:
+                    error = e
+                    ClientStorage.invalidate(sessionid, e, getattr(cl, 'proxy', None))
+                    raise
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    self.running -= 1
+                    self._slots.release()
+                    latency = time.monotonic() - started
+                    record_phase(('upstream:' if cl is not None else 'call:') + name, latency)
+                    if cl is not None:
+                        await self.limiter.feedback_async(key, cl.proxy, latency, error)
+                        proxy_pool.record(cl.proxy, latency, error)
+                        upstream_latency.observe(latency, name, 'error' if error else 'ok')
+                    if error is not None:
+                        errors.inc(type(error).__name__, 'upstream' if cl is not None else 'executor')
+        finally:
+            if not dequeued:
+                self.queued -= 1
+            if self._pending[lane_key] > 1:
+                self._pending[lane_key] -= 1
+            else:
+                del self._pending[lane_key]
+
+    def stats(self) -> Dict:
+        """Executor counters
+        """
+        return {
+            'workers': self.workers,
+            'capacity': self.capacity,
+            'running': self.running,
+            'queued': self.queued,
+            'rejected': self.rejected,
+        }
+
+
+executor = SessionExecutor()
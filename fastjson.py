@@ -0,0 +1,169 @@
+import contextvars
+import functools
+import gzip
+import inspect
+import json
+import os
+from typing import Any, Callable, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional, the standard json module is the fallback
+    orjson = None
+
+FAST_JSON = os.environ.get('FAST_JSON', '0') == '1'
+FAST_JSON_HEADER = 'X-Fast-Json'
+FAST_JSON_GZIP_MIN_BYTES = int(os.environ.get('FAST_JSON_GZIP_MIN_BYTES', 4096))  # 0 turns compression off
+FAST_JSON_GZIP_LEVEL = int(os.environ.get('FAST_JSON_GZIP_LEVEL', 5))
+
+# None: regular FastAPI serialization, otherwise whether the client accepts gzip
+fast_json_gzip: 'contextvars.ContextVar[Optional[bool]]' = contextvars.ContextVar('fast_json_gzip', default=None)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.dict(by_alias=True)
+    try:
+        return pydantic_encoder(obj)
+    except TypeError:
+        return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    """Encode content (pydantic models included) to JSON in one pass
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class Projected:
+    """Endpoint result that no longer matches response_model (see projection.py)
+
+    It always takes the fast path, whether or not fast JSON was asked for.
+    """
+    __slots__ = ('content',)
+
+    def __init__(self, content: Any):
+        self.content = content
+
+
+class FastJSONResponse(Response):
+    """JSON response of already validated models, gzip-compressed if asked for and big enough
+    """
+    media_type = 'application/json'
+
+    def __init__(self, content: Any, status_code: int = 200, compress: bool = False, **kwargs):
+        self.compress = compress
+        super().__init__(content, status_code, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        body = dumps(content)
+        if self.compress and 0 < FAST_JSON_GZIP_MIN_BYTES <= len(body):
+            self.compressed = True
+            return gzip.compress(body, FAST_JSON_GZIP_LEVEL)
+        self.compressed = False
+        return body
+
+    def init_headers(self, headers=None):
+        super().init_headers(headers)
+        if self.compressed:
+            self.raw_headers.append((b'content-encoding', b'gzip'))
+        if self.compress:
+            self.raw_headers.append((b'vary', b'Accept-Encoding'))
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether Accept-Encoding allows gzip, q=0 refuses it (explicitly or through *)
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+def wants_fast_json(request: Request) -> bool:
+    """FAST_JSON for every request, the X-Fast-Json: 1/0 header overrides it per request
+    """
+    header = request.headers.get(FAST_JSON_HEADER)
+    return FAST_JSON if header is None else header == '1'
+
+
+class FastJSONRoute(APIRoute):
+    """Route with an opt-in fast serialization path
+
+    When asked for (see wants_fast_json), the endpoint result is encoded
+    once by FastJSONResponse (orjson if installed) instead of being
+    validated against response_model and run through jsonable_encoder. The
+    models come from instagrapi, they are valid already. response_model
+    still documents the route in the OpenAPI schema. Routes with
+    response_model include/exclude options keep the regular path.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if not any(kwargs.get(option) for option in (
+                'response_model_include', 'response_model_exclude', 'response_model_exclude_unset',
+                'response_model_exclude_defaults', 'response_model_exclude_none')):
+            endpoint = fast_endpoint(endpoint, kwargs.get('status_code') or 200)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def fast_json_handler(request: Request) -> Response:
+            gzip_ok = accepts_gzip(request.headers.get('accept-encoding', ''))
+            token = fast_json_gzip.set(gzip_ok if wants_fast_json(request) else None)
+            try:
+                return await handler(request)
+            finally:
+                fast_json_gzip.reset(token)
+
+        return fast_json_handler
+
+
+def fast_endpoint(endpoint: Callable, status_code: int) -> Callable:
+    """Wrap endpoint to answer FastJSONResponse in fast JSON mode or for a Projected result
+
+    Headers and status set on the endpoint's Response parameter are kept.
+    """
+
+    def respond(result: Any, kwargs) -> Any:
+        compress = fast_json_gzip.get()
+        if isinstance(result, Projected):
+            result, compress = result.content, bool(compress)
+        elif compress is None or isinstance(result, Response):
+            return result
+        response = FastJSONResponse(result, status_code, compress=compress)
+        for value in kwargs.values():
+            if isinstance(value, Response):
+                response.raw_headers.extend(
+                    (name, header) for name, header in value.raw_headers if name != b'content-length')
+                if value.status_code:
+                    response.status_code = value.status_code
+        return response
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return respond(await endpoint(*args, **kwargs), kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            return respond(endpoint(*args, **kwargs), kwargs)
+    return wrapper
@@ -1,63 +1,123 @@
+import asyncio
 import tempfile
 import os
-from instagrapi.story import StoryBuilder
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Union
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from executor import executor
+from render import RENDER_PRESET, renderer
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+UPLOAD_MEMORY_BUDGET = int(os.environ.get('UPLOAD_MEMORY_BUDGET', 64 * 1024 * 1024))
+
+Upload = Union[bytes, UploadFile]
+
+
+class UploadBudget:
+    """Bound upload bytes held in memory at once, over all requests
+
+    Uploads are copied chunk by chunk, every chunk in flight takes one slot
+    of chunk_size bytes, so concurrent large uploads wait instead of growing
+    memory.
+    """
+
+    def __init__(self, limit: int = UPLOAD_MEMORY_BUDGET, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.slots = max(1, limit // chunk_size)
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created lazily to bind to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.slots)
+        return self._semaphore
+
+    async def save(self, upload: Upload, path: str) -> str:
+        """Write upload to path without reading it whole
+        """
+        if isinstance(upload, (bytes, bytearray)):
+            await run_in_threadpool(_write_bytes, path, upload)
+            return path
+        with open(path, 'wb') as fp:
+            while True:
+                async with self.semaphore:
+                    chunk = await upload.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    await run_in_threadpool(fp.write, chunk)
+        return path
+
+
+def _write_bytes(path: str, content: bytes):
+    with open(path, 'wb') as fp:
+        fp.write(content)
 
 
-async def photo_upload_story_as_video(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.jpg') as fp:
-        fp.write(content)
+upload_budget = UploadBudget()
+
+
+@asynccontextmanager
+async def upload_path(upload: Upload, suffix: str) -> AsyncIterator[str]:
+    """Temporary file with the upload content, removed on exit
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        yield await upload_budget.save(upload, path)
+    finally:
+        os.unlink(path)
+
+
+async def photo_upload_story_as_video(cl, content: Upload, preset: Optional[str] = None, **kwargs):
+    async with upload_path(content, '.jpg') as path:
         mentions = kwargs.get('mentions') or []
         caption = kwargs.get('caption') or ''
-        video = StoryBuilder(fp.name, caption, mentions).photo(15)
-        return cl.video_upload_to_story(video.path, **kwargs)
+        async with renderer.rendered('photo', path, caption, mentions, 15, preset or RENDER_PRESET) as video:
+            return await executor.run(cl.sessionid, cl.video_upload_to_story, video, **kwargs)
 
 
-async def photo_upload_story_as_photo(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.jpg') as fp:
-        fp.write(content)
-        return cl.photo_upload_to_story(fp.name, **kwargs)
+async def photo_upload_story_as_photo(cl, content: Upload, **kwargs):
+    async with upload_path(content, '.jpg') as path:
+        return await executor.run(cl.sessionid, cl.photo_upload_to_story, path, **kwargs)
 
 
-async def video_upload_story(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as fp:
-        fp.write(content)
+async def video_upload_story(cl, content: Upload, preset: Optional[str] = None, **kwargs):
+    async with upload_path(content, '.mp4') as path:
         mentions = kwargs.get('mentions') or []
         caption = kwargs.get('caption') or ''
-        video = StoryBuilder(fp.name, caption, mentions).video(15)
-        return cl.video_upload_to_story(video.path, **kwargs)
+        async with renderer.rendered('video', path, caption, mentions, 15, preset or RENDER_PRESET) as video:
+            return await executor.run(cl.sessionid, cl.video_upload_to_story, video, **kwargs)
 
 
-async def photo_upload_post(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.jpg') as fp:
-        fp.write(content)
-        return cl.photo_upload(fp.name, **kwargs)
+async def photo_upload_post(cl, content: Upload, **kwargs):
+    async with upload_path(content, '.jpg') as path:
+        return await executor.run(cl.sessionid, cl.photo_upload, path, **kwargs)
 
 
-async def video_upload_post(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as fp:
-        fp.write(content)
-        return cl.video_upload(fp.name, **kwargs)
+async def video_upload_post(cl, content: Upload, **kwargs):
+    async with upload_path(content, '.mp4') as path:
+        return await executor.run(cl.sessionid, cl.video_upload, path, **kwargs)
 
 
-async def album_upload_post(cl, files, **kwargs):
+async def album_upload_post(cl, files: List[UploadFile], **kwargs):
     with tempfile.TemporaryDirectory() as td:
-        paths = []
-        for i in range(len(files)):
-            filename, ext = os.path.splitext(files[i].filename)
-            fp = tempfile.NamedTemporaryFile(suffix=ext, delete=False, dir=td)
-            fp.write(await files[i].read())
-            fp.close()
-            paths.append(fp.name)
-        return cl.album_upload(paths, **kwargs)
-
-
-async def igtv_upload_post(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as fp:
-        fp.write(content)
-        return cl.igtv_upload(fp.name, **kwargs)
+        paths = [
+            os.path.join(td, f'{i}{os.path.splitext(file.filename)[1]}')
+            for i, file in enumerate(files)
+        ]
+        await asyncio.gather(*[upload_budget.save(file, path) for file, path in zip(files, paths)])
+        return await executor.run(cl.sessionid, cl.album_upload, paths, **kwargs)
 
 
-async def clip_upload_post(cl, content, **kwargs):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as fp:
-        fp.write(content)
-        return cl.clip_upload(fp.name, **kwargs)
+async def igtv_upload_post(cl, content: Upload, **kwargs):
+    async with upload_path(content, '.mp4') as path:
+        return await executor.run(cl.sessionid, cl.igtv_upload, path, **kwargs)
+
+
+async def clip_upload_post(cl, content: Upload, **kwargs):
+    async with upload_path(content, '.mp4') as path:
+        return await executor.run(cl.sessionid, cl.clip_upload, path, **kwargs)
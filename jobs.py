@@ -0,0 +1,431 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import UploadFile
+from fastapi.encoders import jsonable_encoder
+from instagrapi.types import (Location, StoryHashtag, StoryLink, StoryLocation, StoryMedia, StoryMention,
+                              StorySticker, Usertag)
+from pydantic import parse_obj_as
+from starlette.concurrency import run_in_threadpool
+
+import helpers
+from executor import executor
+from pages import (Pager, comments_page, followers_page, following_page, hashtag_page, user_medias_page,
+                   usertag_page)
+from snapshots import sync as sync_snapshot
+from storages import SESSION_DB, ClientStorage, SQLiteStore, session_key
+
+JOB_DB = os.environ.get('JOB_DB', SESSION_DB)
+JOB_DIR = os.environ.get('JOB_DIR', './jobs')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_SESSION_CONCURRENCY = int(os.environ.get('JOB_SESSION_CONCURRENCY', 1))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_STALE_AFTER = float(os.environ.get('JOB_STALE_AFTER', 30))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# params of upload jobs, converted from JSON to the instagrapi types
+POST_PARAMS = {'caption': str, 'usertags': List[Usertag], 'location': Location, 'extra_data': Dict[str, str]}
+STORY_PARAMS = {'caption': str, 'mentions': List[StoryMention], 'locations': List[StoryLocation],
+                'links': List[StoryLink], 'hashtags': List[StoryHashtag], 'stickers': List[StorySticker],
+                'medias': List[StoryMedia], 'extra_data': Dict[str, str]}
+
+
+class JobStore(SQLiteStore):
+    """Jobs and their partial results, in the session database by default
+
+    updated_at doubles as heartbeat of running jobs, so a job whose process
+    died is found by age, whichever process owned it.
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        'id TEXT PRIMARY KEY, '
+        'kind TEXT NOT NULL, '
+        'sessionid TEXT NOT NULL, '
+        'proxy TEXT NOT NULL, '
+        'params TEXT NOT NULL, '
+        'file TEXT, '
+        'state TEXT NOT NULL, '
+        'cursor TEXT, '
+        'progress INTEGER NOT NULL DEFAULT 0, '
+        'result TEXT, '
+        'error TEXT, '
+        'created_at REAL NOT NULL, '
+        'updated_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)',
+        'CREATE TABLE IF NOT EXISTS job_items ('
+        'job_id TEXT NOT NULL, '
+        'seq INTEGER NOT NULL, '
+        'item TEXT NOT NULL, '
+        'PRIMARY KEY (job_id, seq))',
+    )
+    columns = ('id', 'kind', 'sessionid', 'proxy', 'params', 'file', 'state', 'cursor', 'progress',
+               'result', 'error', 'created_at', 'updated_at')
+
+    def create(self, kind: str, sessionid: str, proxy: str, params: Dict, file: Optional[str] = None,
+               job_id: Optional[str] = None) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, sessionid, proxy, params, file, state, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, sessionid, proxy or '', json.dumps(params), file, QUEUED, now, now)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._connection().execute(
+            f'SELECT {", ".join(self.columns)} FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.columns, row))
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def claim(self, per_session: int) -> Optional[Dict]:
+        """Mark the oldest queued job whose session is under per_session running jobs as running
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            running = dict(conn.execute(
+                'SELECT sessionid, COUNT(*) FROM jobs WHERE state = ? GROUP BY sessionid', (RUNNING,)
+            ).fetchall())
+            job_id = None
+            for candidate, sessionid in conn.execute(
+                    'SELECT id, sessionid FROM jobs WHERE state = ? ORDER BY created_at', (QUEUED,)):
+                if running.get(sessionid, 0) < per_session:
+                    job_id = candidate
+                    break
+            if job_id is not None:
+                conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?', (RUNNING, time.time(), job_id))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return self.get(job_id) if job_id else None
+
+    def save_page(self, job_id: str, items: List[Any], cursor: Optional[str]) -> int:
+        """Append a page of items and its continuation cursor in one transaction
+        """
+        with self._connection() as conn:
+            progress = conn.execute('SELECT progress FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_items (job_id, seq, item) VALUES (?, ?, ?)',
+                [(job_id, progress + i, json.dumps(jsonable_encoder(item))) for i, item in enumerate(items)]
+            )
+            conn.execute(
+                'UPDATE jobs SET progress = ?, cursor = ?, updated_at = ? WHERE id = ?',
+                (progress + len(items), cursor, time.time(), job_id)
+            )
+        return progress + len(items)
+
+    def items(self, job_id: str, offset: int = 0, limit: int = 1000) -> List[str]:
+        """JSON encoded items in order, from offset
+        """
+        return [row[0] for row in self._connection().execute(
+            'SELECT item FROM job_items WHERE job_id = ? AND seq >= ? ORDER BY seq LIMIT ?', (job_id, offset, limit)
+        )]
+
+    def finish(self, job_id: str, result: Any = None):
+        with self._connection() as conn:
+            conn.execute('UPDATE jobs SET state = ?, result = ?, updated_at = ? WHERE id = ?',
+                         (DONE, json.dumps(jsonable_encoder(result)), time.time(), job_id))
+
+    def fail(self, job_id: str, error: str):
+        with self._connection() as conn:
+            conn.execute('UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?',
+                         (FAILED, error, time.time(), job_id))
+
+    def heartbeat(self, job_ids: List[str]):
+        with self._connection() as conn:
+            conn.executemany('UPDATE jobs SET updated_at = ? WHERE id = ? AND state = ?',
+                             [(time.time(), job_id, RUNNING) for job_id in job_ids])
+
+    def requeue(self, job_ids: List[str]):
+        with self._connection() as conn:
+            conn.executemany('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state = ?',
+                             [(QUEUED, time.time(), job_id, RUNNING) for job_id in job_ids])
+
+    def recover(self, resumable: List[str], stale_after: float = JOB_STALE_AFTER) -> int:
+        """Requeue running jobs without heartbeat, fail the ones that can't be resumed safely
+        """
+        deadline = time.time() - stale_after
+        marks = ','.join('?' * len(resumable)) or "''"
+        with self._connection() as conn:
+            requeued = conn.execute(
+                f'UPDATE jobs SET state = ?, updated_at = ? WHERE state = ? AND updated_at < ? AND kind IN ({marks})',
+                (QUEUED, time.time(), RUNNING, deadline, *resumable)
+            ).rowcount
+            failed = conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE state = ? AND updated_at < ?',
+                (FAILED, 'Interrupted by restart, check the account before resubmitting',
+                 time.time(), RUNNING, deadline)
+            ).rowcount
+        return requeued + failed
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._connection().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+class JobContext:
+    """What a job kind sees: its params, saved progress and a way to persist pages
+    """
+
+    def __init__(self, queue: 'JobQueue', job: Dict):
+        self.queue = queue
+        self.id = job['id']
+        self.sessionid = job['sessionid']
+        self.proxy = job['proxy'] or None
+        self.params = job['params']
+        self.file = job['file']
+        self.cursor = job['cursor']
+        self.progress = job['progress']
+
+    async def client(self):
+        clients = self.queue.clients
+        return await executor.run(self.sessionid, clients.get, self.sessionid, self.proxy)
+
+    async def save_page(self, items: List, cursor: Optional[str]):
+        self.progress = await run_in_threadpool(self.queue.store.save_page, self.id, items, cursor)
+        self.cursor = cursor
+
+
+class JobKind(NamedTuple):
+    run: Callable[[JobContext], Awaitable[Any]]
+    resumable: bool  # safe to run again after an interruption
+    required: Tuple[str, ...] = ()  # params checked at submit time
+    upload: bool = False  # needs a file at submit time
+    types: Optional[Dict[str, Any]] = None  # only these params, converted to their types (None: any JSON)
+
+
+def convert_params(types: Optional[Dict[str, Any]], params: Dict) -> Dict:
+    """params converted to their types, ValueError for unknown or invalid ones
+    """
+    if types is None:
+        return params
+    unknown = [name for name in params if name not in types]
+    if unknown:
+        raise ValueError(f'Unknown params {", ".join(unknown)}, expected some of {", ".join(types)}')
+    return {name: parse_obj_as(types[name], value) for name, value in params.items()}
+
+
+def scrape(page: Callable, *names: str, resolve: Optional[Callable] = None) -> JobKind:
+    """Job reading a paginated list with Pager, resumed from the last saved page
+
+    Params: the page arguments by name, amount (0 = whole list).
+    """
+    async def run(job: JobContext):
+        amount = int(job.params.get('amount') or 0)
+        cl = await job.client()
+        args = [job.params[name] for name in names]
+        if resolve:
+            args = await resolve(job, cl, *args)
+        if not (amount and job.progress >= amount):
+            pager = Pager(job.sessionid, cl, page, *args, amount=amount - job.progress if amount else 0,
+                          cursor=job.cursor)
+            async for items in pager:
+                await job.save_page(items, pager.next_cursor)
+        return {'count': job.progress}
+
+    return JobKind(run, resumable=True, required=names)
+
+
+def upload(helper: Callable, types: Dict[str, Any], required: Tuple[str, ...] = ()) -> JobKind:
+    """Job posting the file stored at submit time, params (see types) go to the upload helper
+    """
+    async def run(job: JobContext):
+        cl = await job.client()
+        params = convert_params(types, job.params)
+        with open(job.file, 'rb') as fp:
+            return await helper(cl, UploadFile(os.path.basename(job.file), file=fp), **params)
+
+    return JobKind(run, resumable=False, required=required, upload=True, types=types)
+
+
+def snapshot(kind: str) -> JobKind:
+    """Job storing a followers/following snapshot (see snapshots.sync)
+
+    Params: user_id, full.
+    """
+    async def run(job: JobContext):
+        cl = await job.client()
+        return await sync_snapshot(job.sessionid, cl, str(job.params['user_id']), kind, bool(job.params.get('full')))
+
+    return JobKind(run, resumable=True, required=('user_id',))
+
+
+async def _media_id(job: JobContext, cl, media_id: str):
+    return [await executor.run(job.sessionid, cl.media_id, media_id)]
+
+
+async def _hashtag_tab(tab_key: str, job: JobContext, cl, name: str):
+    return [name, tab_key]
+
+
+JOB_KINDS: Dict[str, JobKind] = {
+    'user_followers': scrape(followers_page, 'user_id'),
+    'user_following': scrape(following_page, 'user_id'),
+    'user_medias': scrape(user_medias_page, 'user_id'),
+    'media_comments': scrape(comments_page, 'media_id', resolve=_media_id),
+    'media_tagged_posts': scrape(usertag_page, 'user_id'),
+    'hashtag_medias_top': scrape(hashtag_page, 'name', resolve=partial(_hashtag_tab, 'top')),
+    'hashtag_medias_recent': scrape(hashtag_page, 'name', resolve=partial(_hashtag_tab, 'recent')),
+    'followers_snapshot': snapshot('followers'),
+    'following_snapshot': snapshot('following'),
+    'photo_upload': upload(helpers.photo_upload_post, POST_PARAMS, required=('caption',)),
+    'video_upload': upload(helpers.video_upload_post, POST_PARAMS, required=('caption',)),
+    'clip_upload': upload(helpers.clip_upload_post, dict(POST_PARAMS, configure_timeout=int, feed_show=str),
+                          required=('caption',)),
+    'igtv_upload': upload(helpers.igtv_upload_post, dict(POST_PARAMS, title=str, configure_timeout=int),
+                          required=('title', 'caption')),
+    'photo_upload_to_story': upload(helpers.photo_upload_story_as_photo, STORY_PARAMS),
+    'photo_upload_to_story_as_video': upload(helpers.photo_upload_story_as_video, dict(STORY_PARAMS, preset=str)),
+    'video_upload_to_story': upload(helpers.video_upload_story, dict(STORY_PARAMS, preset=str)),
+}
+
+
+class JobQueue:
+    """Persistent job queue executed by a pool of asyncio workers
+
+    Jobs are claimed from SQLite, so queued work survives restarts and can be
+    shared by several processes. At most per_session jobs of one session run
+    at once. Jobs of a process that died are picked up again once their
+    heartbeat is older than JOB_STALE_AFTER.
+    """
+
+    def __init__(self, store: Optional[JobStore] = None, clients: Optional[ClientStorage] = None,
+                 workers: int = JOB_WORKERS, per_session: int = JOB_SESSION_CONCURRENCY,
+                 kinds: Optional[Dict[str, JobKind]] = None, folder: str = JOB_DIR):
+        self.store = store or JobStore(JOB_DB)
+        self.clients = clients or ClientStorage()
+        self.workers = workers
+        self.per_session = per_session
+        self.kinds = JOB_KINDS if kinds is None else kinds
+        self.folder = folder
+        self.active: Dict[str, asyncio.Task] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = None
+
+    @property
+    def wakeup(self) -> asyncio.Event:
+        # created lazily to bind to the running event loop
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def submit(self, kind: str, sessionid: str, proxy: Optional[str], params: Dict,
+                     file: Optional[UploadFile] = None) -> str:
+        """Queue a job, an uploaded file is saved next to the queue first
+        """
+        if kind not in self.kinds:
+            raise ValueError(f'Unknown job kind "{kind}", expected one of {", ".join(self.kinds)}')
+        missing = [name for name in self.kinds[kind].required if name not in params]
+        if missing:
+            raise ValueError(f'Job kind "{kind}" needs params {", ".join(missing)}')
+        if self.kinds[kind].upload and file is None:
+            raise ValueError(f'Job kind "{kind}" needs a file')
+        convert_params(self.kinds[kind].types, params)
+        job_id = uuid.uuid4().hex
+        path = None
+        if file is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            path = os.path.join(self.folder, job_id + os.path.splitext(file.filename)[1])
+            await helpers.upload_budget.save(file, path)
+        await run_in_threadpool(self.store.create, kind, session_key(sessionid), proxy, params, path, job_id)
+        self.wakeup.set()
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """Job state without its session and file
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {name: job[name] for name in ('id', 'kind', 'state', 'progress', 'cursor', 'result', 'error',
+                                             'params', 'created_at', 'updated_at')}
+
+    async def follow(self, job_id: str, offset: int = 0) -> AsyncIterator[str]:
+        """NDJSON lines of the job items from offset until the job ends, then its final state
+        """
+        while True:
+            status = await run_in_threadpool(self.status, job_id)
+            items = await run_in_threadpool(self.store.items, job_id, offset)
+            for item in items:
+                yield item + '\n'
+            offset += len(items)
+            if items:
+                continue
+            if status['state'] in (DONE, FAILED):
+                yield json.dumps({name: status[name] for name in ('state', 'error', 'result')}) + '\n'
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def start(self):
+        await run_in_threadpool(self.store.recover, self.resumable())
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._heartbeat()))
+
+    async def stop(self):
+        """Cancel workers, resumable jobs go back to the queue
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def resumable(self) -> List[str]:
+        return [name for name, kind in self.kinds.items() if kind.resumable]
+
+    async def _worker(self):
+        while True:
+            job = await run_in_threadpool(self.store.claim, self.per_session)
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+            self.wakeup.set()
+
+    async def _run(self, job: Dict):
+        self.active[job['id']] = asyncio.current_task()
+        requeued = False
+        try:
+            result = await self.kinds[job['kind']].run(JobContext(self, job))
+            await run_in_threadpool(self.store.finish, job['id'], result)
+        except asyncio.CancelledError:
+            if self.kinds[job['kind']].resumable:
+                await run_in_threadpool(self.store.requeue, [job['id']])
+                requeued = True
+            else:
+                await run_in_threadpool(self.store.fail, job['id'], 'Interrupted by shutdown')
+            raise
+        except Exception as e:
+            await run_in_threadpool(self.store.fail, job['id'], f'{type(e).__name__}: {e}')
+        finally:
+            del self.active[job['id']]
+            if job['file'] and not requeued and os.path.exists(job['file']):
+                os.unlink(job['file'])
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(JOB_STALE_AFTER / 3)
+            await run_in_threadpool(self.store.heartbeat, list(self.active))
+            await run_in_threadpool(self.store.recover, self.resumable())
+
+    def stats(self) -> Dict:
+        return dict(self.store.counts(), workers=self.workers, per_session=self.per_session, active=len(self.active))
+
+
+jobs = JobQueue()
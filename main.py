@@ -1,21 +1,42 @@
 import json
+import os
 import random
 from pathlib import Path
 from typing import List, Optional, Dict
 
 import pkg_resources
-from fastapi import Depends, Form
-from fastapi import FastAPI, Request
+from fastapi import Depends, File, Form, HTTPException, Query, UploadFile
+from fastapi import FastAPI, Request, Response
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from instagrapi import Client
-from instagrapi.types import Media, UserShort, User, Story
-from starlette.responses import JSONResponse, FileResponse
+from instagrapi.types import Hashtag, Media, UserShort, User, Story
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
+from batches import fan_out, parse_items
+from caches import flights, response_cache
 from dependencies import ClientStorage, get_clients
+from downloads import album_entries, media_url, stream_download, stream_zip, url_entries
+from executor import ExecutorSaturated, executor
+from fastjson import FastJSONRoute
+from jobs import jobs
+from mediacache import cached_download, cleanup_folder, media_cache
+from metrics import Gauge, MetricsMiddleware, errors, registry
+from pages import (Pager, collect, comments_page, followers_page, following_page, hashtag_page, ndjson_stream,
+                   single_page, user_medias_page, usertag_page)
+from profiling import ProfilingMiddleware, profiler
+from projection import FIELDS_DESCRIPTION, InvalidFields, parse_fields, project
+from proxies import ProxyUnavailable, proxy_pool
+from ratelimit import RateLimited, limiter
+from shared import shared_state
+from snapshots import diff as diff_pks, snapshots, sync as sync_snapshot
+from storages import session_key
+import shortcodes
 
 app = FastAPI()
+app.router.route_class = FastJSONRoute
 
 # CORS settings
 app.add_middleware(
@@ -24,7 +45,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Profile-Id"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
+BATCH_TOO_LARGE = {"description": "More items than BATCH_MAX_ITEMS"}
+
+registry.register(Gauge('executor_calls', 'Executor calls by state (queue depth is queued)',
+                        lambda: {(state,): executor.stats()[state] for state in ('running', 'queued')}, ('state',)))
+registry.register(Gauge('executor_rejected_total', 'Calls rejected by a saturated executor',
+                        lambda: executor.stats()['rejected']))
+registry.register(Gauge('cache_hit_ratio', 'Hit ratio by cache',
+                        lambda: {
+                            ('client_pool',): ClientStorage.pool.stats()['hit_ratio'],
+                            ('response',): response_cache.stats()['hit_ratio'],
+                            ('single_flight',): flights.stats()['shared_ratio'],
+                            ('media',): media_cache.stats()['hit_ratio'],
+                        }, ('cache',)))
+registry.register(Gauge('cache_size_bytes', 'Size by cache',
+                        lambda: {('response',): response_cache.stats()['size'], ('media',): media_cache.size},
+                        ('cache',)))
+registry.register(Gauge('client_pool_size', 'Warm Clients in the pool', lambda: ClientStorage.pool.stats()['size']))
+
+if shared_state is not None:  # worker of serve.py
+    limiter.shared = shared_state
+    response_cache.shared = shared_state
+
+
+@app.on_event("startup")
+async def cleanup_media_cache():
+    await run_in_threadpool(media_cache.cleanup)
+
+
+@app.on_event("startup")
+async def start_jobs():
+    await jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop()
 
 
 @app.get("/", tags=["system"], summary="Show Docs")
@@ -49,6 +110,110 @@ async def version():
     return versions
 
 
+@app.get("/metrics", tags=["system"], summary="Get Prometheus metrics")
+async def metrics():
+    """Get metrics in Prometheus text format
+    """
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/clients/pool", tags=["system"], summary="Get client pool stats")
+async def clients_pool():
+    """Get warm client pool counters
+    """
+    return ClientStorage.pool.stats()
+
+
+@app.get("/cache/stats", tags=["system"], summary="Get response cache stats")
+async def cache_stats():
+    """Get shared response cache counters
+    """
+    return dict(response_cache.stats(), flights=flights.stats())
+
+
+@app.get("/download/cache/stats", tags=["system"], summary="Get media cache stats")
+async def media_cache_stats():
+    """Get media cache counters
+    """
+    return media_cache.stats()
+
+
+@app.post("/download/cache/cleanup", tags=["system"], summary="Remove orphaned media files")
+async def media_cache_cleanup(older_than: float = Form(3600)):
+    """Remove abandoned cache downloads, and media files older than older_than seconds left in DOWNLOAD_CLEANUP_DIR
+    """
+    if older_than <= 0:
+        raise HTTPException(status_code=400, detail="older_than must be a positive number of seconds")
+    removed = await run_in_threadpool(media_cache.cleanup)
+    removed += await run_in_threadpool(cleanup_folder, older_than)
+    return {'removed': removed}
+
+
+@app.get("/proxies", tags=["system"], summary="Get proxy group health")
+async def proxies_health():
+    """Get latency, failures and ejection state of every proxy group member
+    """
+    return proxy_pool.stats()
+
+
+@app.get("/ratelimit/budgets", tags=["system"], summary="Get rate limit budgets")
+async def ratelimit_budgets(sessionid: Optional[str] = None):
+    """Get current rate (calls/s) and tokens per session and proxy, only the given session if any
+    """
+    return limiter.budgets(session_key(sessionid) if sessionid else None)
+
+
+@app.get("/profiling/stats", tags=["system"], summary="Get profiler stats")
+async def profiling_stats():
+    """Get profiler settings and counters
+    """
+    return profiler.stats()
+
+
+@app.post("/profiling/configure", tags=["system"], summary="Switch profiling on or off")
+async def profiling_configure(enabled: bool = Form(...),
+                              rate: Optional[float] = Form(1.0),
+                              slow_after: Optional[float] = Form(None)):
+    """Profile the given share (0..1) of all requests while enabled, set the slow-request threshold in seconds
+    """
+    profiler.configure(enabled, rate, slow_after)
+    return profiler.stats()
+
+
+@app.get("/profiling/profiles", tags=["system"], summary="List request profiles")
+async def profiling_profiles():
+    """List the latest profiled requests, newest first
+    """
+    return [
+        {key: report[key] for key in ('id', 'method', 'route', 'status', 'duration', 'samples')}
+        for report in reversed(profiler.profiles)
+    ]
+
+
+@app.get("/profiling/profiles/{profile_id}", tags=["system"], summary="Get request profile")
+async def profiling_profile(profile_id: int):
+    """Get the sampled stacks of a request, its id comes in the X-Profile-Id response header
+    """
+    report = profiler.profile(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found (or already dropped)")
+    return report
+
+
+@app.get("/profiling/slow", tags=["system"], summary="Get slow requests")
+async def profiling_slow():
+    """Get the latest requests slower than SLOW_REQUEST_SECONDS, newest first
+    """
+    return list(reversed(profiler.slow))
+
+
+@app.get("/executor/stats", tags=["system"], summary="Get executor stats")
+async def executor_stats():
+    """Get thread pool executor counters
+    """
+    return executor.stats()
+
+
 # Start Routers
 
 # AUTH
@@ -61,7 +226,8 @@ async def auth_login(username: str = Form(...), password: str = Form(...), verif
     """
     cl = clients.client()
     if proxy != "":
-        cl.set_proxy(proxy)
+        cl.set_proxy(clients.proxies.resolve(proxy, session_key(username)))
+        clients.proxies.mount(cl)
 
     if locale != "":
         cl.set_locale(locale)
@@ -69,7 +235,9 @@ async def auth_login(username: str = Form(...), password: str = Form(...), verif
     if timezone != "":
         cl.set_timezone_offset(timezone)
 
-    result = cl.login(
+    result = await executor.run(
+        username,
+        cl.login,
         username,
         password,
         verification_code=verification_code
@@ -85,8 +253,8 @@ async def auth_relogin(sessionid: str = Form(...), proxy: str = Form(...),
                        clients: ClientStorage = Depends(get_clients)) -> bool:
     """Relogin by username and password (with clean cookies)
     """
-    cl = clients.get(sessionid, proxy)
-    result = cl.relogin()
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.relogin)
     return result
 
 
@@ -94,10 +262,17 @@ async def auth_relogin(sessionid: str = Form(...), proxy: str = Form(...),
 async def settings_get(sessionid: str, proxy: str, clients: ClientStorage = Depends(get_clients)) -> str:
     """Get client's settings
     """
-    cl = clients.get(sessionid, proxy)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
     return str(cl.get_settings())
 
 
+@app.get("/auth/session/status", tags=["auth"], responses={404: {"description": "Not found"}})
+async def session_status(sessionid: str) -> Dict:
+    """Get cached session validity (valid, expired, invalid or unknown)
+    """
+    return ClientStorage.validator.status(session_key(sessionid))
+
+
 # @app.post("/auth/settings/set", tags=["auth"], responses={404: {"description": "Not found"}})
 # async def settings_set(settings: str = Form(...), sessionid: Optional[str] = Form(""),
 #                        clients: ClientStorage = Depends(get_clients)) -> str:
@@ -124,134 +299,255 @@ async def settings_get(sessionid: str, proxy: str, clients: ClientStorage = Depe
 # MEDIA
 
 @app.get("/media/pk_from_code", tags=["media"], responses={404: {"description": "Not found"}})
-async def media_pk_from_code(code: str = Form(...), proxy: str = Form(...)) -> str:
-    """Get media pk from code
+async def media_pk_from_code(code: str, proxy: Optional[str] = Query("", deprecated=True)) -> str:
+    """Get media pk from code (converted locally, proxy is ignored)
     """
-    return str(Client(proxy=proxy).media_pk_from_code(code))
+    return str(shortcodes.pk_from_code(code))
 
 
 @app.get("/media/pk_from_url", tags=["media"], responses={404: {"description": "Not found"}})
-async def media_pk_from_url(url: str = Form(...), proxy: str = Form(...)) -> str:
-    """Get Media PK from URL
+async def media_pk_from_url(url: str, proxy: Optional[str] = Query("", deprecated=True)) -> str:
+    """Get Media PK from URL (converted locally, proxy is ignored)
     """
-    return str(Client(proxy=proxy).media_pk_from_url(url))
+    return str(shortcodes.pk_from_url(url))
+
+
+@app.get("/media/code_from_pk", tags=["media"], responses={404: {"description": "Not found"}})
+async def media_code_from_pk(pk: int) -> str:
+    """Get media code from pk
+    """
+    return shortcodes.code_from_pk(pk)
+
+
+@app.post("/media/convert/batch", tags=["media"], responses={404: {"description": "Not found"}})
+async def media_convert_batch(codes: Optional[List[str]] = Form(None), urls: Optional[List[str]] = Form(None),
+                              pks: Optional[List[str]] = Form(None)) -> Dict:
+    """Convert many codes / URLs to pks and pks to codes (no Client, no upstream calls)
+    """
+    pks_by_code, code_errors = shortcodes.pks_from_codes(parse_items(codes or []))
+    pks_by_url, url_errors = shortcodes.pks_from_urls(parse_items(urls or []))
+    codes_by_pk, pk_errors = shortcodes.codes_from_pks(parse_items(pks or []))
+    return {
+        'codes': {code: str(pk) for code, pk in pks_by_code.items()},
+        'urls': {url: str(pk) for url, pk in pks_by_url.items()},
+        'pks': codes_by_pk,
+        'errors': {**code_errors, **url_errors, **pk_errors},
+    }
 
 
 @app.post("/media/info", response_model=Media, tags=["media"], responses={404: {"description": "Not found"}})
 async def media_info(sessionid: str = Form(...), pk: int = Form(...), proxy: str = Form(...),
                      use_cache: Optional[bool] = Form(True),
+                     fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                      clients: ClientStorage = Depends(get_clients)) -> Media:
     """Get media info by pk
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.media_info(pk, use_cache)
+    include = parse_fields(fields, Media)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.media_info, pk, use_cache)
+
+    return project(await response_cache.get_or_fetch('media', pk, fetch, refresh=not use_cache), include)
+
+
+@app.post("/media/info/batch", tags=["media"], responses={404: {"description": "Not found"}, 413: BATCH_TOO_LARGE})
+async def media_info_batch(sessionid: str = Form(...), pks: List[str] = Form(...), proxy: str = Form(...),
+                           use_cache: Optional[bool] = Form(True),
+                           clients: ClientStorage = Depends(get_clients)) -> Dict:
+    """Get media info for many pks (partial results with per-item errors)
+    """
+    async def call(cl, lane, pk):
+        pk = int(pk)
+
+        async def fetch():
+            return await executor.run_lane(sessionid, lane, cl.media_info, pk, use_cache)
+
+        return await response_cache.get_or_fetch('media', pk, fetch, refresh=not use_cache)
+
+    return await fan_out(clients, sessionid, proxy, parse_items(pks), call)
 
 
 @app.post("/media/user_medias", response_model=List[Media], tags=["media"],
           responses={404: {"description": "Not found"}})
-async def user_medias(sessionid: str = Form(...), user_id: int = Form(...), amount: Optional[int] = Form(50),
-                      proxy: str = Form(...),
+async def user_medias(response: Response, sessionid: str = Form(...), user_id: int = Form(...),
+                      amount: Optional[int] = Form(50), proxy: str = Form(...),
+                      paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
+                      fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                       clients: ClientStorage = Depends(get_clients)) -> List[Media]:
-    """Get a user's media
+    """Get a user's media (paginate=true or cursor for X-Next-Cursor)
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_medias(user_id, amount)
+    include = parse_fields(fields, Media)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if paginate or cursor:
+        pager = Pager(sessionid, cl, user_medias_page, user_id, amount=amount, cursor=cursor)
+        return project(await collect(pager, response), include)
+    return project(await executor.run(sessionid, cl.user_medias, user_id, amount), include)
 
 
 @app.post("/media/likers", response_model=List[UserShort], tags=["media"],
           responses={404: {"description": "Not found"}})
 async def media_likers(sessionid: str = Form(...), media_id: str = Form(...), proxy: str = Form(...),
+                       stream: Optional[bool] = Form(False),
                        clients: ClientStorage = Depends(get_clients)) -> List[UserShort]:
-    """Get user's likers
+    """Get user's likers (stream=true for NDJSON; one upstream page, no cursor)
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.media_likers(media_id)
+    if stream:
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await ndjson_stream(single_page(executor.run(sessionid, cl.media_likers, media_id)))
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.media_likers, media_id)
+
+    return await flights.do(('media_likers', session_key(sessionid), media_id), fetch)
 
 
 @app.post('/media/comments', tags=["media"], responses={404: {"description": "Not found"}})
-async def get_comments(sessionid: str = Form(...), media_id: str = Form(...), amount: int = Form(30),
-                       proxy: str = Form(...),
+async def get_comments(response: Response, sessionid: str = Form(...), media_id: str = Form(...),
+                       amount: int = Form(30), proxy: str = Form(...), stream: Optional[bool] = Form(False),
+                       paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
                        clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.media_comments(media_id, amount)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream or paginate or cursor:
+        media_id = await executor.run(sessionid, cl.media_id, media_id)
+        pager = Pager(sessionid, cl, comments_page, media_id, amount=amount, cursor=cursor)
+        if stream:
+            return await ndjson_stream(pager, with_cursor=paginate or bool(cursor))
+        return await collect(pager, response)
+    return await executor.run(sessionid, cl.media_comments, media_id, amount)
 
 
 @app.post("/media/tagged_post_by_id", tags=["media"], responses={404: {"description": "Not found"}})
 async def get_tagged_posts_by_user_id(
+        response: Response,
         sessionid: str = Form(...),
         userid: int = Form(...),
         amount: int = Form(...),
         proxy: str = Form(...),
-        sleep: Optional[int] = Form(2),
+        sleep: Optional[int] = Form(None, deprecated=True),
+        paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
         clients: ClientStorage = Depends(get_clients)) -> List[UserShort]:
-    cl = clients.get(sessionid, proxy)
-
-    posts = cl.usertag_medias_gql(userid, amount, sleep)
-
-    return posts
+    """Get medias the user is tagged in, paced by the rate limiter (sleep is ignored)
+    """
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await collect(Pager(sessionid, cl, usertag_page, userid, amount=amount, cursor=cursor), response)
 
 
 @app.post("/media/tagged_post_by_username", tags=["media"], responses={404: {"description": "Not found"}})
 async def get_tagged_posts_by_user_name(
+        response: Response,
         sessionid: str = Form(...),
         username: str = Form(...),
         amount: int = Form(...),
         proxy: str = Form(...),
-        sleep: Optional[int] = Form(2),
+        sleep: Optional[int] = Form(None, deprecated=True),
+        paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
         clients: ClientStorage = Depends(get_clients)) -> List[UserShort]:
-    cl = clients.get(sessionid, proxy)
-
-    user_id = int(cl.user_id_from_username(username))
-    posts = cl.usertag_medias_gql(user_id, amount, sleep)
-
-    return posts
+    """Get medias the user is tagged in, paced by the rate limiter (sleep is ignored)
+    """
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    user_id = int(await executor.run(sessionid, cl.user_id_from_username, username))
+    return await collect(Pager(sessionid, cl, usertag_page, user_id, amount=amount, cursor=cursor), response)
 
 
 # USER
 
 @app.post("/user/followers", response_model=Dict[int, UserShort], tags=["user"],
           responses={404: {"description": "Not found"}})
-async def user_followers(sessionid: str = Form(...), user_id: str = Form(...), use_cache: Optional[bool] = Form(True),
-                         proxy: str = Form(...),
+async def user_followers(response: Response, sessionid: str = Form(...), user_id: str = Form(...),
+                         use_cache: Optional[bool] = Form(True), proxy: str = Form(...),
+                         stream: Optional[bool] = Form(False), paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
                          amount: Optional[int] = Form(12), clients: ClientStorage = Depends(get_clients)) -> Dict[
     int, UserShort]:
-    """Get user's followers
+    """Get user's followers (stream=true for NDJSON, paginate=true or cursor for X-Next-Cursor)
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_followers(user_id, use_cache, amount)
+    if stream or paginate or cursor:
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        pager = Pager(sessionid, cl, followers_page, user_id, amount=amount, cursor=cursor)
+        if stream:
+            return await ndjson_stream(pager, with_cursor=paginate or bool(cursor))
+        return {user.pk: user for user in await collect(pager, response)}
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.user_followers, user_id, use_cache, amount)
+
+    return await flights.do(('user_followers', session_key(sessionid), user_id, use_cache, amount), fetch)
 
 
 @app.post("/user/following", response_model=Dict[int, UserShort], tags=["user"],
           responses={404: {"description": "Not found"}})
-async def user_following(sessionid: str = Form(...), user_id: str = Form(...), use_cache: Optional[bool] = Form(True),
-                         proxy: str = Form(...),
+async def user_following(response: Response, sessionid: str = Form(...), user_id: str = Form(...),
+                         use_cache: Optional[bool] = Form(True), proxy: str = Form(...),
+                         stream: Optional[bool] = Form(False), paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
                          amount: Optional[int] = Form(0), clients: ClientStorage = Depends(get_clients)) -> Dict[
     int, UserShort]:
-    """Get user's followers information
+    """Get user's followers information (stream=true for NDJSON, paginate=true or cursor for X-Next-Cursor)
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_following(user_id, use_cache, amount)
+    if stream or paginate or cursor:
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        pager = Pager(sessionid, cl, following_page, user_id, amount=amount, cursor=cursor)
+        if stream:
+            return await ndjson_stream(pager, with_cursor=paginate or bool(cursor))
+        return {user.pk: user for user in await collect(pager, response)}
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.user_following, user_id, use_cache, amount)
+
+    return await flights.do(('user_following', session_key(sessionid), user_id, use_cache, amount), fetch)
 
 
 @app.post("/user/info", response_model=User, tags=["user"], responses={404: {"description": "Not found"}})
 async def user_info(sessionid: str = Form(...), user_id: str = Form(...), use_cache: Optional[bool] = Form(True),
                     proxy: str = Form(...),
+                    fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                     clients: ClientStorage = Depends(get_clients)) -> User:
     """Get user object from user id
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_info(user_id, use_cache)
+    include = parse_fields(fields, User)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.user_info, user_id, use_cache)
+
+    return project(await response_cache.get_or_fetch('user', str(user_id), fetch, refresh=not use_cache), include)
+
+
+@app.post("/user/info/batch", tags=["user"], responses={404: {"description": "Not found"}, 413: BATCH_TOO_LARGE})
+async def user_info_batch(sessionid: str = Form(...), user_ids: List[str] = Form(...),
+                          use_cache: Optional[bool] = Form(True), proxy: str = Form(...),
+                          clients: ClientStorage = Depends(get_clients)) -> Dict:
+    """Get user objects for many user ids (partial results with per-item errors)
+    """
+    async def call(cl, lane, user_id):
+        async def fetch():
+            return await executor.run_lane(sessionid, lane, cl.user_info, user_id, use_cache)
+
+        return await response_cache.get_or_fetch('user', user_id, fetch, refresh=not use_cache)
+
+    return await fan_out(clients, sessionid, proxy, parse_items(user_ids), call)
 
 
 @app.post("/user/info_by_username", response_model=User, tags=["user"], responses={404: {"description": "Not found"}})
 async def user_info_by_username(sessionid: str = Form(...), username: str = Form(...),
                                 proxy: str = Form(...),
                                 use_cache: Optional[bool] = Form(True),
+                                fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                                 clients: ClientStorage = Depends(get_clients)) -> User:
     """Get user object from username
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_info_by_username(username, use_cache)
+    include = parse_fields(fields, User)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        user = await executor.run(sessionid, cl.user_info_by_username, username, use_cache)
+        response_cache.set('user', str(user.pk), user)
+        return user
+
+    user = await response_cache.get_or_fetch('user', ('username', username.lower()), fetch, refresh=not use_cache)
+    return project(user, include)
 
 
 @app.post("/user/id_from_username", response_model=int, tags=["user"], responses={404: {"description": "Not found"}})
@@ -259,8 +555,23 @@ async def user_id_from_username(sessionid: str = Form(...), username: str = Form
                                 clients: ClientStorage = Depends(get_clients)) -> int:
     """Get user id from username
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_id_from_username(username)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await executor.run(sessionid, cl.user_id_from_username, username)
+
+
+@app.post("/user/id_from_username/batch", tags=["user"], responses={404: {"description": "Not found"}, 413: BATCH_TOO_LARGE})
+async def user_id_from_username_batch(sessionid: str = Form(...), usernames: List[str] = Form(...),
+                                      proxy: str = Form(...),
+                                      clients: ClientStorage = Depends(get_clients)) -> Dict:
+    """Get user ids for many usernames (partial results with per-item errors)
+    """
+    async def call(cl, lane, username):
+        async def fetch():
+            return await executor.run_lane(sessionid, lane, cl.user_id_from_username, username)
+
+        return await response_cache.get_or_fetch('user', ('id', username.lower()), fetch)
+
+    return await fan_out(clients, sessionid, proxy, parse_items(usernames), call)
 
 
 @app.post("/user/username_from_id", response_model=str, tags=["user"], responses={404: {"description": "Not found"}})
@@ -268,24 +579,24 @@ async def username_from_user_id(sessionid: str = Form(...), user_id: int = Form(
                                 clients: ClientStorage = Depends(get_clients)) -> str:
     """Get username from user id
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.username_from_user_id(user_id)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await executor.run(sessionid, cl.username_from_user_id, user_id)
 
 
 @app.post('/user/search_follower', tags=["user"], responses={404: {"description": "Not found"}})
 async def search_followers(sessionid: str = Form(...), user_id: int = Form(...), query: str = Form(...),
                            proxy: str = Form(...),
                            clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.search_followers(user_id, query)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await executor.run(sessionid, cl.search_followers, user_id, query)
 
 
 @app.post('/user/search_following', tags=["user"], responses={404: {"description": "Not found"}})
 async def search_followings(sessionid: str = Form(...), user_id: int = Form(...), query: str = Form(...),
                             proxy: str = Form(...),
                             clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.search_following(user_id, query)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await executor.run(sessionid, cl.search_following, user_id, query)
 
 
 # STORY
@@ -293,71 +604,98 @@ async def search_followings(sessionid: str = Form(...), user_id: int = Form(...)
           responses={404: {"description": "Not found"}})
 async def story_user_stories(sessionid: str = Form(...), user_id: str = Form(...), amount: Optional[int] = Form(None),
                              proxy: str = Form(...),
+                             fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                              clients: ClientStorage = Depends(get_clients)) -> List[Story]:
     """Get a user's stories
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.user_stories(user_id, amount)
+    include = parse_fields(fields, Story)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return project(await executor.run(sessionid, cl.user_stories, user_id, amount), include)
 
 
 @app.post("/story/info", response_model=Story, tags=["story"], responses={404: {"description": "Not found"}})
 async def story_info(sessionid: str = Form(...), story_pk: int = Form(...), use_cache: Optional[bool] = Form(True),
                      proxy: str = Form(...),
+                     fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                      clients: ClientStorage = Depends(get_clients)) -> Story:
     """Get Story by pk or id
     """
-    cl = clients.get(sessionid, proxy)
-    return cl.story_info(story_pk, use_cache)
+    include = parse_fields(fields, Story)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.story_info, story_pk, use_cache)
+
+    return project(await response_cache.get_or_fetch('story', story_pk, fetch, refresh=not use_cache), include)
 
 
 # Download
 
 
 @app.post("/download/download_story_by_url", tags=["Download"], responses={404: {"description": "Not found"}})
-async def story_download_by_url(sessionid: str = Form(...),
+async def story_download_by_url(request: Request,
+                                sessionid: str = Form(...),
                                 url: str = Form(...),
                                 filename: Optional[str] = Form(""),
                                 folder: Optional[Path] = Form(""),
                                 proxy: str = Form(...),
                                 returnFile: Optional[bool] = Form(True),
+                                stream: Optional[bool] = Form(False),
                                 clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.story_download_by_url(url, filename, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        story_pk = int(cl.story_pk_from_url(url))
+        story = await response_cache.get_or_fetch('story', story_pk,
+                                                  lambda: executor.run(sessionid, cl.story_info, story_pk))
+        return await stream_download(cl, media_url(story), request.headers.get('range'), filename)
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(int(cl.story_pk_from_url(url)), 'story',
+                                     lambda tmp: executor.run(sessionid, cl.story_download_by_url, url, filename, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.story_download_by_url, url, filename, folder)
 
 
 @app.post("/download/download_story_by_pk", tags=["Download"], responses={404: {"description": "Not found"}})
-async def story_download(sessionid: str = Form(...),
+async def story_download(request: Request,
+                         sessionid: str = Form(...),
                          story_pk: int = Form(...),
                          filename: Optional[str] = Form(""),
                          folder: Optional[Path] = Form(""),
                          proxy: str = Form(...),
                          returnFile: Optional[bool] = Form(True),
+                         stream: Optional[bool] = Form(False),
                          clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.story_download(story_pk, filename, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        story = await response_cache.get_or_fetch('story', story_pk,
+                                                  lambda: executor.run(sessionid, cl.story_info, story_pk))
+        return await stream_download(cl, media_url(story), request.headers.get('range'), filename)
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(story_pk, 'story',
+                                     lambda tmp: executor.run(sessionid, cl.story_download, story_pk, filename, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.story_download, story_pk, filename, folder)
 
 
 @app.post("/download/download_photo_by_pk", tags=["Download"], responses={404: {"description": "Not found"}})
-async def photo_download(sessionid: str = Form(...),
+async def photo_download(request: Request,
+                         sessionid: str = Form(...),
                          media_pk: int = Form(...),
                          folder: Optional[Path] = Form(""),
                          proxy: str = Form(...),
                          returnFile: Optional[bool] = Form(True),
+                         stream: Optional[bool] = Form(False),
                          clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.photo_download(media_pk, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        media = await response_cache.get_or_fetch('media', media_pk,
+                                                  lambda: executor.run(sessionid, cl.media_info, media_pk))
+        return await stream_download(cl, media_url(media), request.headers.get('range'))
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(media_pk, 'photo',
+                                     lambda tmp: executor.run(sessionid, cl.photo_download, media_pk, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.photo_download, media_pk, folder)
 
 
 @app.post("/download/download_photo_by_url", tags=["Download"], responses={404: {"description": "Not found"}})
@@ -367,27 +705,33 @@ async def photo_download_by_urll(sessionid: str = Form(...),
                                  proxy: str = Form(...),
                                  returnFile: Optional[bool] = Form(True),
                                  clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.photo_download_by_url(media_pk, filename)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.photo_download_by_url, media_pk, filename)
     if returnFile:
-        return FileResponse(result)
+        return FileResponse(result, background=BackgroundTask(os.remove, result))
     else:
         return result
 
 
 @app.post("/download/download_video_by_pk", tags=["Download"], responses={404: {"description": "Not found"}})
-async def video_download(sessionid: str = Form(...),
+async def video_download(request: Request,
+                         sessionid: str = Form(...),
                          media_pk: int = Form(...),
                          folder: Optional[Path] = Form(""),
                          proxy: str = Form(...),
                          returnFile: Optional[bool] = Form(True),
+                         stream: Optional[bool] = Form(False),
                          clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.video_download(media_pk, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        media = await response_cache.get_or_fetch('media', media_pk,
+                                                  lambda: executor.run(sessionid, cl.media_info, media_pk))
+        return await stream_download(cl, media_url(media), request.headers.get('range'))
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(media_pk, 'video',
+                                     lambda tmp: executor.run(sessionid, cl.video_download, media_pk, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.video_download, media_pk, folder)
 
 
 @app.post("/download/download_video_by_url", tags=["Download"], responses={404: {"description": "Not found"}})
@@ -397,10 +741,10 @@ async def video_download_by_urll(sessionid: str = Form(...),
                                  proxy: str = Form(...),
                                  returnFile: Optional[bool] = Form(True),
                                  clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.video_download_by_url(media_pk, filename)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.video_download_by_url, media_pk, filename)
     if returnFile:
-        return FileResponse(result)
+        return FileResponse(result, background=BackgroundTask(os.remove, result))
     else:
         return result
 
@@ -410,36 +754,55 @@ async def album_download(sessionid: str = Form(...),
                          media_pk: int = Form(...),
                          folder: Optional[Path] = Form(""),
                          proxy: str = Form(...),
+                         zip: Optional[bool] = Form(False),
                          clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.album_download(media_pk, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if zip:
+        media = await response_cache.get_or_fetch('media', media_pk,
+                                                  lambda: executor.run(sessionid, cl.media_info, media_pk))
+        return await stream_zip(cl, album_entries(media), f'{media.user.username}_{media.pk}.zip')
+    result = await executor.run(sessionid, cl.album_download, media_pk, folder)
     return result
 
 
 @app.post("/download/download_album_by_url", tags=["Download"], responses={404: {"description": "Not found"}})
 async def album_download_by_urll(sessionid: str = Form(...),
-                                 media_pk: int = Form(...),
+                                 media_pk: Optional[int] = Form(None, deprecated=True),
                                  filename: Optional[str] = Form(""),
                                  proxy: str = Form(...),
+                                 urls: Optional[List[str]] = Form(None),
+                                 zip: Optional[bool] = Form(False),
                                  clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.album_download_by_urls(media_pk, filename)
+    """Download the album parts at urls, as one ZIP stream with zip=true (media_pk is ignored)
+    """
+    if not urls:
+        raise HTTPException(status_code=400, detail='urls are required')
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if zip:
+        return await stream_zip(cl, url_entries(urls), filename or 'album.zip')
+    result = await executor.run(sessionid, cl.album_download_by_urls, urls, filename)
     return result
 
 
 @app.post("/download/download_igtv_by_pk", tags=["Download"], responses={404: {"description": "Not found"}})
-async def igtv_download(sessionid: str = Form(...),
+async def igtv_download(request: Request,
+                        sessionid: str = Form(...),
                         media_pk: int = Form(...),
                         folder: Optional[Path] = Form(""),
                         proxy: str = Form(...),
                         returnFile: Optional[bool] = Form(True),
+                        stream: Optional[bool] = Form(False),
                         clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.igtv_download(media_pk, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        media = await response_cache.get_or_fetch('media', media_pk,
+                                                  lambda: executor.run(sessionid, cl.media_info, media_pk))
+        return await stream_download(cl, media_url(media), request.headers.get('range'))
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(media_pk, 'igtv',
+                                     lambda tmp: executor.run(sessionid, cl.igtv_download, media_pk, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.igtv_download, media_pk, folder)
 
 
 @app.post("/download/download_igtv_by_url", tags=["Download"], responses={404: {"description": "Not found"}})
@@ -449,28 +812,34 @@ async def igtv_download_by_urll(sessionid: str = Form(...),
                                 proxy: str = Form(...),
                                 returnFile: Optional[bool] = Form(True),
                                 clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.igtv_download_by_url(media_pk, filename)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.igtv_download_by_url, media_pk, filename)
     if returnFile:
-        return FileResponse(result)
+        return FileResponse(result, background=BackgroundTask(os.remove, result))
     else:
         return result
 
 
 @app.post("/download/download_clip_by_pk", tags=["Download"], summary='for download reels',
           responses={404: {"description": "Not found"}})
-async def clip_download(sessionid: str = Form(...),
+async def clip_download(request: Request,
+                        sessionid: str = Form(...),
                         media_pk: int = Form(...),
                         folder: Optional[Path] = Form(""),
                         proxy: str = Form(...),
                         returnFile: Optional[bool] = Form(True),
+                        stream: Optional[bool] = Form(False),
                         clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.clip_download(media_pk, folder)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    if stream:
+        media = await response_cache.get_or_fetch('media', media_pk,
+                                                  lambda: executor.run(sessionid, cl.media_info, media_pk))
+        return await stream_download(cl, media_url(media), request.headers.get('range'))
     if returnFile:
-        return FileResponse(result)
-    else:
-        return result
+        return await cached_download(media_pk, 'clip',
+                                     lambda tmp: executor.run(sessionid, cl.clip_download, media_pk, tmp),
+                                     request.headers.get('if-none-match'))
+    return await executor.run(sessionid, cl.clip_download, media_pk, folder)
 
 
 @app.post("/download/download_clip_by_url", tags=["Download"], summary='for download reels',
@@ -481,10 +850,10 @@ async def clip_download_by_urll(sessionid: str = Form(...),
                                 proxy: str = Form(...),
                                 returnFile: Optional[bool] = Form(True),
                                 clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.clip_download_by_url(media_pk, filename)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.clip_download_by_url, media_pk, filename)
     if returnFile:
-        return FileResponse(result)
+        return FileResponse(result, background=BackgroundTask(os.remove, result))
     else:
         return result
 
@@ -495,18 +864,18 @@ async def clip_download_by_urll(sessionid: str = Form(...),
 async def send_direct_message_by_username(sessionid: str = Form(...), target_username: str = Form(...),
                                           proxy: str = Form(...),
                                           message_body: str = Form(...), clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    taken_username = cl.user_id_from_username(target_username)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    taken_username = await executor.run(sessionid, cl.user_id_from_username, target_username)
     taken_user_id = int(taken_username)
-    result = cl.direct_send(f"{message_body}", [taken_user_id, ])
+    result = await executor.run(sessionid, cl.direct_send, f"{message_body}", [taken_user_id, ])
     return result
 
 
 @app.post('/direct/send_by_id', tags=["direct"], responses={404: {"description": "Not found"}})
 async def send_direct_message_by_id(sessionid: str = Form(...), target_userid: int = Form(...), proxy: str = Form(...),
                                     message_body: str = Form(...), clients: ClientStorage = Depends(get_clients), ):
-    cl = clients.get(sessionid, proxy)
-    result = cl.direct_send(message_body, [target_userid, ])
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    result = await executor.run(sessionid, cl.direct_send, message_body, [target_userid, ])
     return result
 
 
@@ -526,27 +895,168 @@ async def send_direct_message_by_id(sessionid: str = Form(...), target_userid: i
 # HASHTAG
 
 @app.post('/hashtag/get_top_hashtags', tags=["hashtag"], responses={404: {"description": "Not found"}})
-async def hashtag_top(sessionid: str = Form(...), name: str = Form(...), amount: int = Form(27), proxy: str = Form(...),
+async def hashtag_top(response: Response, sessionid: str = Form(...), name: str = Form(...),
+                      amount: int = Form(27), proxy: str = Form(...), stream: Optional[bool] = Form(False),
+                      paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
+                      fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                       clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.hashtag_medias_top(name, amount)
+    include = parse_fields(fields, Media)
+    if stream or paginate or cursor:
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        pager = Pager(sessionid, cl, hashtag_page, name, 'top', amount=amount, cursor=cursor)
+        if stream:
+            return await ndjson_stream(pager, with_cursor=paginate or bool(cursor), include=include)
+        return project(await collect(pager, response), include)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.hashtag_medias_top, name, amount)
+
+    key = ('hashtag_medias_top', session_key(sessionid), name.lower(), amount)
+    return project(await flights.do(key, fetch), include)
 
 
 @app.post('/hashtag/get_recent_hashtags', tags=["hashtag"], responses={404: {"description": "Not found"}})
-async def hashtag_recent(sessionid: str = Form(...), name: str = Form(...), amount: int = Form(27),
-                         proxy: str = Form(...),
+async def hashtag_recent(response: Response, sessionid: str = Form(...), name: str = Form(...),
+                         amount: int = Form(27), proxy: str = Form(...), stream: Optional[bool] = Form(False),
+                         paginate: Optional[bool] = Form(False), cursor: Optional[str] = Form(None),
+                         fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                          clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.hashtag_medias_recent(name, amount)
+    include = parse_fields(fields, Media)
+    if stream or paginate or cursor:
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        pager = Pager(sessionid, cl, hashtag_page, name, 'recent', amount=amount, cursor=cursor)
+        if stream:
+            return await ndjson_stream(pager, with_cursor=paginate or bool(cursor), include=include)
+        return project(await collect(pager, response), include)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.hashtag_medias_recent, name, amount)
+
+    key = ('hashtag_medias_recent', session_key(sessionid), name.lower(), amount)
+    return project(await flights.do(key, fetch), include)
 
 
 @app.post('/hashtag/get_hashtag_info', tags=["hashtag"], responses={404: {"description": "Not found"}})
 async def hashtag_info(sessionid: str = Form(...), name: str = Form(...), proxy: str = Form(...),
+                       fields: Optional[str] = Form(None, description=FIELDS_DESCRIPTION),
                        clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    result = cl.hashtag_info(
-        name=name, )
-    return result
+    include = parse_fields(fields, Hashtag)
+
+    async def fetch():
+        cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+        return await executor.run(sessionid, cl.hashtag_info, name=name)
+
+    result = await response_cache.get_or_fetch('hashtag', name.lower(), fetch)
+    return project(result, include)
+
+
+# Snapshots
+
+
+@app.post("/snapshots/sync", tags=["snapshots"], responses={404: {"description": "Not found"}})
+async def snapshot_sync(sessionid: str = Form(...), user_id: str = Form(...), kind: str = Form("followers"),
+                        full: Optional[bool] = Form(False), proxy: str = Form(...),
+                        clients: ClientStorage = Depends(get_clients)) -> Dict:
+    """Store a new followers/following snapshot, paging stops early at already known followers unless full=true
+    """
+    if kind not in ('followers', 'following'):
+        raise HTTPException(status_code=400, detail='kind must be followers or following')
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await sync_snapshot(sessionid, cl, user_id, kind, full)
+
+
+@app.get("/snapshots", tags=["snapshots"])
+async def snapshot_list(user_id: str, kind: str = "followers") -> List[Dict]:
+    """List snapshots of an account, newest first
+    """
+    return await run_in_threadpool(snapshots.list, user_id, kind)
+
+
+@app.get("/snapshots/diff", tags=["snapshots"], responses={404: {"description": "Not found"}})
+async def snapshot_diff(from_id: int, to_id: int) -> Dict:
+    """Get pks added and removed between two snapshots of one account
+    """
+    old = await run_in_threadpool(snapshots.get, from_id)
+    new = await run_in_threadpool(snapshots.get, to_id)
+    if old is None or new is None:
+        raise HTTPException(status_code=404, detail='Snapshot not found')
+    if (old.user_id, old.kind) != (new.user_id, new.kind):
+        raise HTTPException(status_code=400, detail='Snapshots belong to different accounts or kinds')
+    added, removed = diff_pks(old.pks, new.pks)
+    return {
+        'from': old.info(),
+        'to': new.info(),
+        'added': [str(pk) for pk in added],
+        'removed': [str(pk) for pk in removed],
+    }
+
+
+@app.get("/snapshots/{snapshot_id}", tags=["snapshots"], responses={404: {"description": "Not found"}})
+async def snapshot_get(snapshot_id: int) -> Dict:
+    """Get a snapshot with its pks
+    """
+    snapshot = await run_in_threadpool(snapshots.get, snapshot_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail='Snapshot not found')
+    return dict(snapshot.info(), pks=[str(pk) for pk in snapshot.pks])
+
+
+# Jobs
+
+
+@app.post("/jobs/submit", tags=["jobs"], responses={404: {"description": "Not found"}})
+async def job_submit(sessionid: str = Form(...),
+                     kind: str = Form(...),
+                     params: Optional[str] = Form("{}"),
+                     proxy: Optional[str] = Form(""),
+                     file: Optional[UploadFile] = File(None)):
+    """Queue a long-running scrape or upload, params is a JSON object (e.g. {"user_id": 1, "amount": 0})
+    """
+    try:
+        params = json.loads(params or "{}")
+    except ValueError:
+        raise HTTPException(status_code=400, detail='params must be a JSON object')
+    try:
+        job_id = await jobs.submit(kind, sessionid, proxy, params, file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {'id': job_id}
+
+
+@app.get("/jobs/stats", tags=["jobs"], summary="Get job queue stats")
+async def job_stats():
+    """Get job counts by state and worker settings
+    """
+    return await run_in_threadpool(jobs.stats)
+
+
+@app.get("/jobs/{job_id}", tags=["jobs"], responses={404: {"description": "Not found"}})
+async def job_status(job_id: str):
+    """Get job state, progress and result
+    """
+    status = await run_in_threadpool(jobs.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return status
+
+
+@app.get("/jobs/{job_id}/items", tags=["jobs"], responses={404: {"description": "Not found"}})
+async def job_items(job_id: str, offset: int = 0, limit: int = 1000):
+    """Get items collected so far, in order
+    """
+    items = await run_in_threadpool(jobs.store.items, job_id, offset, limit)
+    return Response("[" + ",".join(items) + "]", media_type="application/json")
+
+
+@app.get("/jobs/{job_id}/stream", tags=["jobs"], responses={404: {"description": "Not found"}})
+async def job_stream(job_id: str, offset: int = 0):
+    """Stream items as NDJSON while the job runs, ends with a {"state", "error", "result"} record
+    """
+    if await run_in_threadpool(jobs.status, job_id) is None:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return StreamingResponse(jobs.follow(job_id, offset), media_type="application/x-ndjson")
 
 
 # Highlight
@@ -556,15 +1066,52 @@ async def hashtag_info(sessionid: str = Form(...), name: str = Form(...), proxy:
 async def hashtag_top(sessionid: str = Form(...), user_id: str = Form(...), amount: int = Form(5),
                       proxy: str = Form(...),
                       clients: ClientStorage = Depends(get_clients)):
-    cl = clients.get(sessionid, proxy)
-    return cl.user_highlights(user_id, amount)
+    cl = await executor.run(sessionid, clients.get, sessionid, proxy)
+    return await executor.run(sessionid, cl.user_highlights, user_id, amount)
 
 
 # End Routers
 
 
+@app.exception_handler(ExecutorSaturated)
+async def handle_executor_saturated(request, exc: ExecutorSaturated):
+    errors.inc(type(exc).__name__, "request")
+    return JSONResponse({
+        "detail": str(exc),
+        "exc_type": str(type(exc).__name__)
+    }, status_code=503)
+
+
+@app.exception_handler(ProxyUnavailable)
+async def handle_proxy_unavailable(request, exc: ProxyUnavailable):
+    errors.inc(type(exc).__name__, "request")
+    return JSONResponse({
+        "detail": str(exc),
+        "exc_type": str(type(exc).__name__)
+    }, status_code=503)
+
+
+@app.exception_handler(InvalidFields)
+async def handle_invalid_fields(request, exc: InvalidFields):
+    errors.inc(type(exc).__name__, "request")
+    return JSONResponse({
+        "detail": str(exc),
+        "exc_type": str(type(exc).__name__)
+    }, status_code=422)
+
+
+@app.exception_handler(RateLimited)
+async def handle_rate_limited(request, exc: RateLimited):
+    errors.inc(type(exc).__name__, "request")
+    return JSONResponse({
+        "detail": str(exc),
+        "exc_type": str(type(exc).__name__)
+    }, status_code=429, headers={"Retry-After": str(int(exc.retry_after) + 1)})
+
+
 @app.exception_handler(Exception)
 async def handle_exception(request, exc: Exception):
+    errors.inc(type(exc).__name__, "request")
     return JSONResponse({
         "detail": str(exc),
         "exc_type": str(type(exc).__name__)
@@ -0,0 +1,260 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+
+from caches import flights
+
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', './media_cache')
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+MEDIA_CACHE_TMP_TTL = float(os.environ.get('MEDIA_CACHE_TMP_TTL', 3600))
+DOWNLOAD_CLEANUP_DIR = os.environ.get('DOWNLOAD_CLEANUP_DIR', '')  # plain downloads folder to sweep, '' sweeps none
+
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.mp4', '.mov')
+
+
+class CachedFile(NamedTuple):
+    path: str
+    digest: str
+    size: int
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """Size-capped, content-addressed cache of downloaded media
+
+    Blobs are stored once per sha256 (blobs/<digest><ext>), keys
+    (keys/<pk>_<variant>) point at blobs, so identical content is kept once.
+    Least recently used blobs are evicted over max_bytes. The folder is
+    read on first use and only created when something is written to it.
+    """
+
+    def __init__(self, root: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.blobs_dir = self.root / 'blobs'
+        self.keys_dir = self.root / 'keys'
+        self.tmp_dir = self.root / 'tmp'
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._keys: Dict[str, str] = {}
+        self._blobs: 'OrderedDict[str, CachedFile]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._setup_lock = threading.Lock()
+        self._loaded = False
+
+    def _setup(self, create: bool = False) -> bool:
+        """Load the folder once, create it if create; False while there is no folder yet
+        """
+        if self._loaded:
+            return True
+        with self._setup_lock:
+            if not self._loaded:
+                if not create and not self.root.exists():
+                    return False
+                for path in (self.blobs_dir, self.keys_dir, self.tmp_dir):
+                    path.mkdir(parents=True, exist_ok=True)
+                self._load()
+                self._loaded = True
+        return True
+
+    def _load(self):
+        blobs = []
+        for path in self.blobs_dir.iterdir():
+            stat = path.stat()
+            blobs.append((stat.st_atime, CachedFile(str(path), path.stem, stat.st_size)))
+        for _, blob in sorted(blobs):
+            self._blobs[blob.digest] = blob
+            self.size += blob.size
+        for path in self.keys_dir.iterdir():
+            digest = path.read_text().strip()
+            if digest in self._blobs:
+                self._keys[path.name] = digest
+            else:
+                path.unlink()
+
+    @staticmethod
+    def key(pk, variant: str) -> str:
+        return f'{pk}_{variant}'
+
+    def get(self, pk, variant: str) -> Optional[CachedFile]:
+        self._setup()
+        key = self.key(pk, variant)
+        with self._lock:
+            blob = self._blobs.get(self._keys.get(key, ''))
+            if blob is None or not os.path.exists(blob.path):
+                self.misses += 1
+                return None
+            self._blobs.move_to_end(blob.digest)
+            self.hits += 1
+        try:
+            os.utime(blob.path)
+        except OSError:
+            pass
+        return blob
+
+    def tmp_folder(self) -> str:
+        """Fresh folder under the cache for a download in progress
+        """
+        self._setup(create=True)
+        return tempfile.mkdtemp(dir=self.tmp_dir)
+
+    def put_file(self, pk, variant: str, path: str) -> CachedFile:
+        """Move downloaded file into the cache (blocking, hashes the file)
+        """
+        self._setup(create=True)
+        digest = file_digest(path)
+        blob_path = self.blobs_dir / f'{digest}{Path(path).suffix}'
+        key = self.key(pk, variant)
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                shutil.move(path, blob_path)
+                blob = self._blobs[digest] = CachedFile(str(blob_path), digest, blob_path.stat().st_size)
+                self.size += blob.size
+            else:
+                os.unlink(path)
+                self._blobs.move_to_end(digest)
+            key_path = self.keys_dir / key
+            tmp_key = self.tmp_dir / f'{key}.{threading.get_ident()}'
+            tmp_key.write_text(digest)
+            os.replace(tmp_key, key_path)
+            self._keys[key] = digest
+            self._evict(keep=digest)
+        return blob
+
+    def _evict(self, keep: str):
+        while self.size > self.max_bytes and len(self._blobs) > 1:
+            digest = next(iter(self._blobs))
+            if digest == keep:
+                self._blobs.move_to_end(digest)
+                continue
+            blob = self._blobs.pop(digest)
+            self.size -= blob.size
+            self.evictions += 1
+            for key in [key for key, value in self._keys.items() if value == digest]:
+                del self._keys[key]
+                (self.keys_dir / key).unlink(missing_ok=True)
+            Path(blob.path).unlink(missing_ok=True)
+
+    def cleanup(self, max_age: float = MEDIA_CACHE_TMP_TTL) -> int:
+        """Remove abandoned downloads in tmp/ and blobs without keys
+        """
+        if not self._setup():
+            return 0
+        removed = 0
+        deadline = time.time() - max_age
+        for path in self.tmp_dir.iterdir():
+            if path.stat().st_mtime < deadline:
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+                removed += 1
+        with self._lock:
+            referenced = set(self._keys.values())
+            for digest in [digest for digest in self._blobs if digest not in referenced]:
+                blob = self._blobs.pop(digest)
+                self.size -= blob.size
+                Path(blob.path).unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def stats(self) -> Dict:
+        """Cache counters
+        """
+        self._setup()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'keys': len(self._keys),
+                'blobs': len(self._blobs),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def cleanup_folder(max_age: float, folder: str = DOWNLOAD_CLEANUP_DIR) -> int:
+    """Remove media files older than max_age left in the configured folder by plain downloads
+    """
+    if not folder or not os.path.isdir(folder):
+        return 0
+    removed = 0
+    deadline = time.time() - max_age
+    for path in Path(folder).iterdir():
+        if path.is_file() and path.suffix.lower() in MEDIA_EXTENSIONS and path.stat().st_mtime < deadline:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+class CachedFileResponse(FileResponse):
+    """FileResponse with content ETag, served by sendfile when the server supports zero-copy
+    """
+
+    def __init__(self, blob: CachedFile, filename: Optional[str] = None):
+        super().__init__(blob.path, filename=filename, stat_result=os.stat(blob.path),
+                         headers={'ETag': f'"{blob.digest}"', 'Cache-Control': 'public, max-age=86400'})
+
+    async def __call__(self, scope, receive, send):
+        if 'http.response.zerocopy' not in scope.get('extensions', {}):
+            return await super().__call__(scope, receive, send)
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        with open(self.path, 'rb') as fp:
+            await send({'type': 'http.response.zerocopy', 'file': fp, 'more_body': False})
+
+
+def cached_response(blob: CachedFile, if_none_match: Optional[str]) -> Response:
+    """304 when the client already has this content, else the cached file
+    """
+    etag = f'"{blob.digest}"'
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]  # weak comparison
+        if '*' in tags or etag in tags:
+            return Response(status_code=304, headers={'ETag': etag})
+    return CachedFileResponse(blob)
+
+
+media_cache = MediaCache()
+
+
+async def cached_download(pk, variant: str, download: Callable[[str], Awaitable],
+                          if_none_match: Optional[str] = None) -> Response:
+    """Serve (pk, variant) from the media cache, download(folder) -> path on a miss
+
+    Concurrent misses for the same key share one download.
+    """
+    blob = await run_in_threadpool(media_cache.get, pk, variant)
+    if blob is None:
+        async def fetch():
+            folder = media_cache.tmp_folder()
+            try:
+                path = await download(folder)
+                return await run_in_threadpool(media_cache.put_file, pk, variant, str(path))
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+
+        blob = await flights.do(('download', pk, variant), fetch)
+    return cached_response(blob, if_none_match)
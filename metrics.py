@@ -0,0 +1,175 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from starlette.routing import Match
+
+METRICS_BUCKETS = tuple(float(b) for b in os.environ.get(
+    'METRICS_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60').split(','))
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Labels, values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: str, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Labels = (),
+                 buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Labels, List] = {}  # values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *values: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    labels = _labels(self.labels, values, 'le="%s"' % bound)
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _labels(self.labels, values, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{labels} {series[-1]}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, values)} {series[-2]}')
+                lines.append(f'{self.name}_count{_labels(self.labels, values)} {series[-1]}')
+        return lines
+
+
+class Gauge:
+    """Gauge read from a callback at scrape time: value or {label values: value}
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], Union[float, Dict[Labels, float]]],
+                 labels: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.labels = labels
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        value = self.read()
+        samples = value if isinstance(value, dict) else {(): value}
+        for values, sample in sorted(samples.items()):
+            lines.append(f'{self.name}{_labels(self.labels, values)} {float(sample)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Histogram, Gauge]] = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format 0.0.4
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route, until the last body byte',
+    ('method', 'route', 'status')))
+upstream_latency = registry.register(Histogram(
+    'instagrapi_call_duration_seconds', 'Upstream instagrapi call latency by Client method or page function',
+    ('method', 'outcome')))
+session_lookup_latency = registry.register(Histogram(
+    'session_store_lookup_seconds', 'Session settings lookup time by store backend', ('backend',)))
+errors = registry.register(Counter(
+    'errors_total', 'Errors by exception type and where they were raised', ('exc_type', 'source')))
+
+
+def route_path(app, scope) -> str:
+    """Route template of the request (/user/info, /jobs/{job_id}), not its raw path
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, 'path', scope['path'])
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """Observe request latency per route, streaming responses included
+    """
+
+    def __init__(self, app, histogram: Optional[Histogram] = None):
+        self.app = app
+        self.histogram = histogram or request_latency
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = ['500']
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_path(scope['app'], scope) if 'app' in scope else 'unmatched'
+            self.histogram.observe(time.perf_counter() - started, scope['method'], route, status[0])
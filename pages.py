@@ -0,0 +1,188 @@
+import base64
+import json
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from instagrapi import Client
+from instagrapi.extractors import extract_comment, extract_media_gql, extract_media_v1, extract_user_short
+from starlette.responses import Response, StreamingResponse
+
+from executor import executor
+
+# A page function makes exactly one upstream request: page(cl, *args, params) -> (items, next_params).
+# next_params are the query params of the following page, None at the end of the list.
+Page = Tuple[List, Optional[Dict]]
+
+
+def followers_page(cl: Client, user_id: str, params: Optional[Dict]) -> Page:
+    return _friendships_page(cl, f"friendships/{user_id}/followers/", params)
+
+
+def following_page(cl: Client, user_id: str, params: Optional[Dict]) -> Page:
+    return _friendships_page(cl, f"friendships/{user_id}/following/", params)
+
+
+def _friendships_page(cl: Client, endpoint: str, params: Optional[Dict]) -> Page:
+    result = cl.private_request(endpoint, params={
+        "count": 200,
+        "rank_token": cl.rank_token,
+        "search_surface": "follow_list_page",
+        "query": "",
+        "enable_groups": "true",
+        **(params or {}),
+    })
+    max_id = result.get("next_max_id")
+    return [extract_user_short(user) for user in result["users"]], {"max_id": max_id} if max_id else None
+
+
+def user_medias_page(cl: Client, user_id: int, params: Optional[Dict]) -> Page:
+    result = cl.private_request(f"feed/user/{user_id}/", params={
+        "count": 50,
+        "rank_token": cl.rank_token,
+        "ranked_content": "true",
+        **(params or {}),
+    })
+    max_id = result.get("next_max_id")
+    more = result.get("more_available") and max_id
+    return [extract_media_v1(media) for media in result["items"]], {"max_id": max_id} if more else None
+
+
+def comments_page(cl: Client, media_id: str, params: Optional[Dict]) -> Page:
+    result = cl.private_request(f"media/{media_id}/comments/", params)
+    comments = [extract_comment(comment) for comment in result.get("comments") or []]
+    if result.get("has_more_comments") and result.get("next_max_id"):
+        return comments, {"max_id": result["next_max_id"]}
+    if result.get("has_more_headload_comments") and result.get("next_min_id"):
+        return comments, {"min_id": result["next_min_id"]}
+    return comments, None
+
+
+def hashtag_page(cl: Client, name: str, tab_key: str, params: Optional[Dict]) -> Page:
+    result = cl.private_request(
+        f"tags/{name}/sections/",
+        params=params or {},
+        data=cl.with_default_data({
+            "supported_tabs": json.dumps([tab_key]),
+            "include_persistent": "true",
+            "rank_token": cl.rank_token,
+        }),
+    )
+    medias = []
+    for section in result["sections"]:
+        for node in (section.get("layout_content") or {}).get("medias") or []:
+            media = extract_media_v1(node["media"])
+            if f"#{name}" in media.caption_text:
+                medias.append(media)
+    more = result.get("more_available") and result.get("next_max_id")
+    return medias, {"max_id": result["next_max_id"]} if more else None
+
+
+def usertag_page(cl: Client, user_id: int, params: Optional[Dict]) -> Page:
+    variables = {"id": int(user_id), "first": 50, **(params or {})}
+    data = cl.public_graphql_request(variables, query_hash="be13233562af2d229b008d2976b998b5")
+    edges = data["user"]["edge_user_to_photos_of_you"]
+    page_info = edges.get("page_info") or {}
+    more = page_info.get("has_next_page") and page_info.get("end_cursor")
+    return [extract_media_gql(edge["node"]) for edge in edges["edges"]], {"after": page_info["end_cursor"]} if more else None
+
+
+def encode_cursor(kind: str, params: Optional[Dict], skip: int = 0) -> str:
+    """Opaque continuation cursor: page params plus items to skip in that page
+    """
+    raw = json.dumps({"k": kind, "p": params, "s": skip}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, kind: str) -> Tuple[Optional[Dict], int]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        params, skip = data["p"], int(data["s"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+    if data.get("k") != kind:
+        raise ValueError("Cursor belongs to another list")
+    return params, skip
+
+
+class Pager:
+    """Iterate a paginated list page by page (one executor call per upstream page)
+
+    Only one page is held in memory, amount=0 means the whole list. Start
+    from a cursor and read next_cursor afterwards to resume where it stopped
+    (None when the list is exhausted).
+    """
+
+    def __init__(self, sessionid: str, cl: Client, page: Callable[..., Page], *args,
+                 amount: int = 0, cursor: Optional[str] = None):
+        self.sessionid = sessionid
+        self.cl = cl
+        self.page = page
+        self.args = args
+        self.amount = amount
+        self.kind = ":".join([page.__name__, *map(str, args)])
+        self.params, self.skip = decode_cursor(cursor, self.kind) if cursor else (None, 0)
+        self.done = False
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        if self.done:
+            return None
+        return encode_cursor(self.kind, self.params, self.skip)
+
+    async def __aiter__(self) -> AsyncIterator[List]:
+        count = 0
+        while not self.done:
+            items, next_params = await executor.run(self.sessionid, self.page, self.cl, *self.args, self.params)
+            items = items[self.skip:]
+            if self.amount and count + len(items) >= self.amount:
+                taken = self.amount - count
+                if taken < len(items):
+                    self.skip += taken
+                else:
+                    self.params, self.skip, self.done = next_params, 0, next_params is None
+                yield items[:taken]
+                return
+            count += len(items)
+            self.params, self.skip, self.done = next_params, 0, next_params is None
+            yield items
+
+
+async def single_page(items: Awaitable[List]) -> AsyncIterator[List]:
+    """Wrap an unpaginated call as one page
+    """
+    yield await items
+
+
+async def collect(pager: Pager, response: Response) -> List:
+    """Collect pager items, pass the continuation cursor in X-Next-Cursor
+    """
+    items = [item async for page in pager for item in page]
+    if pager.next_cursor:
+        response.headers["X-Next-Cursor"] = pager.next_cursor
+    return items
+
+
+async def ndjson_stream(pages: AsyncIterable[List], with_cursor: bool = False,
+                        include: Optional[Dict] = None) -> StreamingResponse:
+    """Stream one JSON record per item (trimmed to include, see projection.py) as pages arrive
+
+    The first page is fetched before responding, so early errors (user not
+    found, invalid session) still get a regular error response. Later errors
+    end the stream with a {"detail", "exc_type"} record. with_cursor=True
+    ends a Pager stream with a {"next_cursor"} record.
+    """
+    iterator = pages.__aiter__()
+    first = await iterator.__anext__()
+
+    async def lines():
+        try:
+            for item in first:
+                yield item.json(include=include) + "\n"
+            async for items in iterator:
+                for item in items:
+                    yield item.json(include=include) + "\n"
+            if with_cursor:
+                yield json.dumps({"next_cursor": pages.next_cursor}) + "\n"
+        except Exception as e:
+            yield json.dumps({"detail": str(e), "exc_type": str(type(e).__name__)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from instagrapi import Client
+
+POOL_MAX_SIZE = int(os.environ.get('CLIENT_POOL_MAX_SIZE', 256))
+POOL_IDLE_TTL = float(os.environ.get('CLIENT_POOL_IDLE_TTL', 900))
+
+
+class ClientPool:
+    """Warm instagrapi clients keyed by (sessionid, proxy) with LRU and idle TTL eviction
+    """
+
+    def __init__(self, max_size: int = POOL_MAX_SIZE, idle_ttl: float = POOL_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items: 'OrderedDict[Hashable, Tuple[Client, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Client]:
+        """Get warm client or None (counts hit/miss)
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and now - item[1] > self.idle_ttl:
+                del self._items[key]
+                self.evictions += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items[key] = (item[0], now)
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, cl: Client):
+        """Put client to the pool, evict least recently used ones over max_size
+        """
+        with self._lock:
+            self._items[key] = (cl, time.monotonic())
+            self._items.move_to_end(key)
+            self._evict_expired()
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, sessionid: str):
+        """Drop all clients of sessionid (any proxy)
+        """
+        with self._lock:
+            for key in [key for key in self._items if key[0] == sessionid]:
+                del self._items[key]
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._items:
+            key, (_, used) = next(iter(self._items.items()))
+            if used >= deadline:
+                break
+            del self._items[key]
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        """Pool counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'idle_ttl': self.idle_ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,309 @@
+import contextvars
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from metrics import route_path
+from ratelimit import proxy_label
+
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+PROFILE_MAX_DEPTH = int(os.environ.get('PROFILE_MAX_DEPTH', 64))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 10))
+SLOW_REQUEST_KEEP = int(os.environ.get('SLOW_REQUEST_KEEP', 200))
+SLOW_REQUEST_STACK_DEPTH = int(os.environ.get('SLOW_REQUEST_STACK_DEPTH', 12))
+
+IDLE_FUNCTIONS = {'select', 'poll', 'epoll', '_worker', 'wait'}
+
+
+def frame_stack(frame, depth: int = PROFILE_MAX_DEPTH) -> List[str]:
+    """Frames outermost first as "function (file:line)"
+    """
+    stack = []
+    while frame is not None and len(stack) < depth:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno or 0))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class Trace:
+    """Timings of one request: phases, session and proxy, stack samples
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str, profile: bool = False):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.route = path
+        self.status = 500
+        self.session: Optional[str] = None
+        self.proxy: Optional[str] = None
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        self.profile = profile
+        self.phases: Dict[str, List[float]] = {}  # name -> [count, seconds]
+        self.threads: Set[int] = set()
+        self.loop_thread = threading.get_ident()
+        self.samples: Counter = Counter()
+        self.stack: Optional[List[str]] = None
+
+    def record(self, name: str, seconds: float):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0.0]
+        phase[0] += 1
+        phase[1] += seconds
+
+    def elapsed(self) -> float:
+        return self.duration if self.duration is not None else time.monotonic() - self.started
+
+    def summary(self) -> Dict:
+        return {
+            'id': self.id,
+            'method': self.method,
+            'route': self.route,
+            'status': self.status,
+            'session': self.session,
+            'proxy': self.proxy,
+            'started_at': self.started_at,
+            'duration': round(self.elapsed(), 4),
+            'phases': {
+                name: {'count': count, 'seconds': round(seconds, 4)}
+                for name, (count, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][1])
+            },
+        }
+
+    def profile_report(self, interval: float, top: int = 50) -> Dict:
+        """Collapsed stacks (flamegraph input) and self/total sample counts per function
+        """
+        samples = Counter(dict(self.samples))  # the sampler thread may still add to it
+        total = sum(samples.values())
+        own: Counter = Counter()
+        cumulative: Counter = Counter()
+        for stack, count in samples.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                cumulative[frame] += count
+        return dict(
+            self.summary(),
+            interval=interval,
+            samples=total,
+            sampled_seconds=round(total * interval, 4),
+            functions=[
+                {'function': name, 'self': count, 'total': cumulative[name]}
+                for name, count in own.most_common(top)
+            ],
+            stacks=[{'stack': stack, 'samples': count} for stack, count in samples.most_common(top)],
+        )
+
+
+current_trace: 'contextvars.ContextVar[Optional[Trace]]' = contextvars.ContextVar('current_trace', default=None)
+
+
+def record_phase(name: str, seconds: float):
+    """Add seconds spent in a phase to the current request, if any
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(name, seconds)
+
+
+def annotate(session: Optional[str] = None, proxy: Optional[str] = None):
+    """Tag the current request with the session (user id part) and proxy (no credentials) it used
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+    if session and trace.session is None:
+        trace.session = session.split(':')[0]
+    if proxy is not None and trace.proxy is None:
+        trace.proxy = proxy_label(proxy)
+
+
+def traced(fn: Callable) -> Callable:
+    """Wrap fn for a worker thread: it sees the current request and the sampler attributes the thread to it
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return fn
+    context = contextvars.copy_context()
+
+    def call():
+        ident = threading.get_ident()
+        trace.threads.add(ident)
+        try:
+            return context.run(fn)
+        finally:
+            trace.threads.discard(ident)
+    return call
+
+
+class Profiler:
+    """Sampling profiler and slow-request log
+
+    A request sent with the PROFILE_HEADER header (or any request while
+    profiling is switched on, for the given share of requests) is sampled
+    every interval: stacks of the worker threads running its calls, and of
+    the event loop thread while it isn't idle (loop samples are shared by
+    requests running at the same time). The report is kept in a ring of the
+    last PROFILE_KEEP profiles, its id goes back in the response header.
+
+    Requests slower than slow_after land in a ring of the last
+    SLOW_REQUEST_KEEP entries with their phases, session, proxy and a stack
+    snapshot taken while they were still running.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, slow_after: float = SLOW_REQUEST_SECONDS,
+                 keep: int = PROFILE_KEEP, slow_keep: int = SLOW_REQUEST_KEEP):
+        self.interval = interval
+        self.slow_after = slow_after
+        self.enabled = False
+        self.rate = 1.0
+        self.profiles: 'Deque[Dict]' = deque(maxlen=keep)
+        self.slow: 'Deque[Dict]' = deque(maxlen=slow_keep)
+        self.requests = 0
+        self.profiled = 0
+        self._active: Dict[int, Trace] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+
+    def configure(self, enabled: bool, rate: float = 1.0, slow_after: Optional[float] = None):
+        self.enabled = enabled
+        self.rate = max(0.0, min(1.0, rate))
+        if slow_after is not None:
+            self.slow_after = slow_after
+
+    def wants_profile(self, requested: bool) -> bool:
+        return requested or (self.enabled and random.random() < self.rate)
+
+    def begin(self, trace: Trace):
+        self.requests += 1
+        with self._lock:
+            self._active[trace.id] = trace
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+                self._thread.start()
+        if trace.profile:
+            self._wake.set()
+
+    def end(self, trace: Trace):
+        trace.duration = time.monotonic() - trace.started
+        with self._lock:
+            self._active.pop(trace.id, None)
+        if trace.profile:
+            self.profiled += 1
+            self.profiles.append(trace.profile_report(self.interval))
+        if trace.duration >= self.slow_after:
+            if trace.stack is None:
+                trace.stack = self._stack(trace, sys._current_frames())
+            self.slow.append(dict(trace.summary(), stack=trace.stack))
+
+    def _stack(self, trace: Trace, frames: Dict) -> List[str]:
+        for ident in list(trace.threads) or [trace.loop_thread]:
+            frame = frames.get(ident)
+            if frame is not None:
+                return frame_stack(frame, PROFILE_MAX_DEPTH)[-SLOW_REQUEST_STACK_DEPTH:]
+        return []
+
+    def _sample(self):
+        """Sampler thread, exits once no request is in flight
+        """
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                traces = list(self._active.values())
+            profiled = [trace for trace in traces if trace.profile]
+            waiting = [trace for trace in traces if trace.stack is None and trace.elapsed() >= self.slow_after]
+            if profiled or waiting:
+                frames = sys._current_frames()
+                stacks: Dict[int, Optional[str]] = {}
+                for trace in profiled:
+                    for ident in list(trace.threads) + [trace.loop_thread]:
+                        if ident not in stacks:
+                            frame = frames.get(ident)
+                            stack = frame_stack(frame) if frame is not None else []
+                            idle = not stack or stack[-1].split(' ')[0] in IDLE_FUNCTIONS
+                            stacks[ident] = None if idle else ';'.join(stack)
+                        if stacks[ident] is not None:
+                            trace.samples[stacks[ident]] += 1
+                for trace in waiting:
+                    trace.stack = self._stack(trace, frames)
+            if profiled:
+                time.sleep(self.interval)
+            elif self._wake.wait(min(1.0, self.slow_after / 4 or 1.0)):
+                self._wake.clear()
+
+    def profile(self, profile_id: int) -> Optional[Dict]:
+        for report in self.profiles:
+            if report['id'] == profile_id:
+                return report
+        return None
+
+    def stats(self) -> Dict:
+        """Profiler settings and counters
+        """
+        return {
+            'enabled': self.enabled,
+            'rate': self.rate,
+            'interval': self.interval,
+            'slow_after': self.slow_after,
+            'requests': self.requests,
+            'profiled': self.profiled,
+            'in_flight': len(self._active),
+            'profiles': len(self.profiles),
+            'slow': len(self.slow),
+        }
+
+
+profiler = Profiler()
+
+
+class ProfilingMiddleware:
+    """Trace every request for the slow-request log, sample the ones asking for a profile
+    """
+
+    def __init__(self, app, sampler: Optional[Profiler] = None, header: str = PROFILE_HEADER):
+        self.app = app
+        self.profiler = sampler or profiler
+        self.header = header.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        requested = any(name == self.header and value not in (b'', b'0')
+                        for name, value in scope.get('headers', []))
+        trace = Trace(scope['method'], scope['path'], self.profiler.wants_profile(requested))
+        token = current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                trace.status = message['status']
+                if trace.profile:
+                    headers = list(message.get('headers', []))
+                    headers.append((b'x-profile-id', str(trace.id).encode()))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        self.profiler.begin(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            if 'app' in scope:
+                trace.route = route_path(scope['app'], scope)
+            self.profiler.end(trace)
@@ -0,0 +1,66 @@
+from typing import Any, Dict, Optional, Type
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
+
+from fastjson import Projected
+
+Include = Dict[str, Any]  # pydantic include: {name: ... | Include}, '__all__' for items of lists and dicts
+FIELDS_DESCRIPTION = 'Comma separated fields to return, dotted for nested ones (e.g. pk,code,user.username)'
+
+
+class InvalidFields(ValueError):
+    """fields= names a field the model does not have
+    """
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Include]:
+    """Turn 'pk,user.username,resources.thumbnail_url' into a pydantic include of model
+
+    Paths are dotted, every part must be a field of the model at its level.
+    Items of list and dict fields are reached through the field name alone.
+    A whole field wins over paths inside it. None or '' keeps all fields.
+    """
+    if not fields:
+        return None
+    include: Include = {}
+    for path in fields.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node, current = include, model
+        names = path.split('.')
+        for depth, name in enumerate(names):
+            field = getattr(current, '__fields__', {}).get(name)
+            if field is None:
+                raise InvalidFields(f'Unknown field "{path}" of {model.__name__}')
+            if depth == len(names) - 1:
+                node[name] = ...
+            elif node.get(name) is ...:
+                break
+            else:
+                node = node.setdefault(name, {})
+                if field.shape != SHAPE_SINGLETON:
+                    node = node.setdefault('__all__', {})
+                current = field.type_
+    return include or None
+
+
+def project(content: Any, include: Optional[Include]) -> Any:
+    """Trim models (alone, in lists or dict values) to include before serialization
+
+    Without include the content is returned as is, for the usual response_model path.
+    """
+    if include is None:
+        return content
+    return Projected(_project(content, include))
+
+
+def _project(content: Any, include: Include) -> Any:
+    if isinstance(content, BaseModel):
+        return content.dict(include=include, by_alias=True)
+    if isinstance(content, dict):
+        return {key: _project(value, include) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [_project(item, include) for item in content]
+    return content
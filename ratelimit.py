@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from instagrapi.exceptions import (ClientThrottledError, FeedbackRequired, PleaseWaitFewMinutes, RateLimitError,
+                                   SentryBlock)
+
+RATE_LIMIT_SESSION_RATE = float(os.environ.get('RATE_LIMIT_SESSION_RATE', 0.5))
+RATE_LIMIT_SESSION_BURST = float(os.environ.get('RATE_LIMIT_SESSION_BURST', 5))
+RATE_LIMIT_PROXY_RATE = float(os.environ.get('RATE_LIMIT_PROXY_RATE', 5))
+RATE_LIMIT_PROXY_BURST = float(os.environ.get('RATE_LIMIT_PROXY_BURST', 20))
+RATE_LIMIT_MIN_RATE = float(os.environ.get('RATE_LIMIT_MIN_RATE', 0.02))
+RATE_LIMIT_MAX_RATE = float(os.environ.get('RATE_LIMIT_MAX_RATE', 5))
+RATE_LIMIT_INCREASE = float(os.environ.get('RATE_LIMIT_INCREASE', 0.02))
+RATE_LIMIT_DECREASE = float(os.environ.get('RATE_LIMIT_DECREASE', 0.5))
+RATE_LIMIT_SLOW_LATENCY = float(os.environ.get('RATE_LIMIT_SLOW_LATENCY', 5))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 60))
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 10000))
+RATE_LIMIT_SHARED_TTL = float(os.environ.get('RATE_LIMIT_SHARED_TTL', 24 * 3600))
+
+THROTTLE_ERRORS = (ClientThrottledError, FeedbackRequired, PleaseWaitFewMinutes, RateLimitError, SentryBlock)
+
+
+class RateLimited(Exception):
+    """Waiting for a token would take longer than RATE_LIMIT_MAX_WAIT
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket with an AIMD rate (tokens per second)
+
+    reserve() takes a token now and returns how long to wait for it, so
+    tokens can go negative and callers queue up in reservation order.
+    Successes raise the rate additively, throttling halves it.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self.calls = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def feedback(self, latency: float, throttled: bool):
+        self.calls += 1
+        if throttled:
+            self.throttled += 1
+            self.rate = max(RATE_LIMIT_MIN_RATE, self.rate * RATE_LIMIT_DECREASE)
+            self.tokens = min(self.tokens, 0.0)
+        elif latency > RATE_LIMIT_SLOW_LATENCY:
+            self.rate = max(RATE_LIMIT_MIN_RATE, self.rate * (1 - (1 - RATE_LIMIT_DECREASE) / 4))
+        else:
+            self.rate = min(RATE_LIMIT_MAX_RATE, self.rate + RATE_LIMIT_INCREASE)
+
+    def budget(self) -> Dict:
+        self._refill(time.monotonic())
+        return {
+            'rate': round(self.rate, 4),
+            'burst': self.burst,
+            'tokens': round(self.tokens, 2),
+            'calls': self.calls,
+            'throttled': self.throttled,
+        }
+
+
+class RateLimiter:
+    """Adaptive token buckets per sessionid and per proxy ('' is the direct connection)
+
+    Every upstream call takes a token from both buckets of its Client.
+    session and proxy are the initial (rate, burst) of new buckets. With
+    shared set (a SharedState, see serve.py) the buckets live there, so all
+    workers spend one budget per proxy; time.monotonic() is system-wide.
+    """
+
+    def __init__(self, session: Tuple[float, float] = (RATE_LIMIT_SESSION_RATE, RATE_LIMIT_SESSION_BURST),
+                 proxy: Tuple[float, float] = (RATE_LIMIT_PROXY_RATE, RATE_LIMIT_PROXY_BURST),
+                 max_wait: float = RATE_LIMIT_MAX_WAIT, max_buckets: int = RATE_LIMIT_MAX_BUCKETS,
+                 shared=None):
+        self.limits = {'session': session, 'proxy': proxy}
+        self.max_wait = max_wait
+        self.max_buckets = max_buckets
+        self.shared = shared
+        self._buckets: 'OrderedDict[Tuple[str, str], TokenBucket]' = OrderedDict()
+
+    def bucket(self, scope: str, key: str) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            bucket = TokenBucket(*self.limits[scope])
+            self._buckets[(scope, key)] = bucket
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end((scope, key))
+        return bucket
+
+    def _update_shared(self, session: str, proxy: Optional[str], fn: Callable[[List[TokenBucket]], Any]) -> Any:
+        """Apply fn to both buckets in shared state, in one transaction
+        """
+        keys = [shared_key('session', session), shared_key('proxy', proxy or '')]
+
+        def update(values: Dict[str, TokenBucket]):
+            buckets = [values.get(key) or TokenBucket(*self.limits[key.split(':')[1]]) for key in keys]
+            return dict(zip(keys, buckets)), fn(buckets)
+
+        return self.shared.update(keys, update, ttl=RATE_LIMIT_SHARED_TTL)
+
+    def _reserve(self, buckets: List[TokenBucket]) -> float:
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait > self.max_wait:
+            for bucket in buckets:
+                bucket.refund()
+            raise RateLimited(f'Rate limit budget exhausted, retry in {wait:.0f}s', wait)
+        return wait
+
+    def reserve(self, session: str, proxy: Optional[str]) -> float:
+        """Take a token from both buckets, return seconds to wait before the call
+        """
+        if self.shared is not None:
+            return self._update_shared(session, proxy, self._reserve)
+        return self._reserve([self.bucket('session', session), self.bucket('proxy', proxy or '')])
+
+    def feedback(self, session: str, proxy: Optional[str], latency: float, exc: Optional[BaseException] = None):
+        throttled = isinstance(exc, THROTTLE_ERRORS)
+        if self.shared is not None:
+            self._update_shared(session, proxy, lambda buckets: [
+                bucket.feedback(latency, throttled) for bucket in buckets])
+            return
+        self.bucket('session', session).feedback(latency, throttled)
+        self.bucket('proxy', proxy or '').feedback(latency, throttled)
+
+    async def reserve_async(self, session: str, proxy: Optional[str]) -> float:
+        """reserve() off the event loop when the buckets are in shared state
+        """
+        if self.shared is None:
+            return self.reserve(session, proxy)
+        return await asyncio.get_event_loop().run_in_executor(None, self.reserve, session, proxy)
+
+    async def feedback_async(self, session: str, proxy: Optional[str], latency: float,
+                             exc: Optional[BaseException] = None):
+        if self.shared is None:
+            return self.feedback(session, proxy, latency, exc)
+        await asyncio.get_event_loop().run_in_executor(None, self.feedback, session, proxy, latency, exc)
+
+    def budgets(self, session: Optional[str] = None) -> Dict:
+        """Current rate and tokens of every bucket
+
+        Session keys are shortened to their user id part, proxies lose their credentials.
+        """
+        result = {'sessions': {}, 'proxies': {}}
+        if self.shared is not None:
+            buckets = [(tuple(name.split(':', 2)[1:]), bucket) for name, bucket in self.shared.items('ratelimit:')]
+        else:
+            buckets = list(self._buckets.items())
+        for (scope, key), bucket in buckets:
+            if scope == 'session':
+                if session is None or key == session:
+                    result['sessions'][key.split(':')[0]] = bucket.budget()
+            elif session is None:
+                result['proxies'][proxy_label(key)] = bucket.budget()
+        return result
+
+
+def shared_key(scope: str, key: str) -> str:
+    """Key of a bucket in shared state
+    """
+    return f'ratelimit:{scope}:{key}'
+
+
+def proxy_label(proxy: str) -> str:
+    """Proxy without credentials, for reports
+    """
+    if not proxy:
+        return 'direct'
+    url = urlparse(proxy)
+    return f'{url.scheme}://{url.hostname}:{url.port}' if url.hostname else proxy
+
+
+limiter = RateLimiter()
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional
+
+from fastapi.encoders import jsonable_encoder
+from instagrapi import story
+from moviepy.editor import CompositeVideoClip
+from starlette.concurrency import run_in_threadpool
+
+from caches import flights
+from mediacache import CachedFile, MediaCache, file_digest
+
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+RENDER_START_METHOD = os.environ.get('RENDER_START_METHOD', 'spawn')
+RENDER_PRESET = os.environ.get('RENDER_PRESET', 'default')
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', './render_cache')
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 1024 ** 3))
+
+
+class RenderPreset(NamedTuple):
+    width: int
+    height: int
+    bitrate: str
+    speed: str  # x264 preset, ultrafast..veryslow
+    threads: int = 1
+
+
+RENDER_PRESETS: Dict[str, RenderPreset] = {
+    'fast': RenderPreset(540, 960, '1500k', 'ultrafast'),
+    'default': RenderPreset(720, 1280, '3500k', 'veryfast'),
+    'quality': RenderPreset(1080, 1920, '6000k', 'medium', threads=2),
+}
+
+
+class _PresetClip(CompositeVideoClip):
+    """CompositeVideoClip encoding with the preset of the current job
+    """
+    preset: RenderPreset = RENDER_PRESETS['default']
+
+    def write_videofile(self, filename, **kwargs):
+        kwargs.update(bitrate=self.preset.bitrate, preset=self.preset.speed,
+                      threads=self.preset.threads, logger=None)
+        return super().write_videofile(filename, **kwargs)
+
+
+def _render(kind: str, path: str, caption: str, mentions: List, max_duration: int, preset: str) -> str:
+    """Build story video in a worker process, returns the output path
+    """
+    _PresetClip.preset = RENDER_PRESETS[preset]
+    story.CompositeVideoClip = _PresetClip
+    builder = story.StoryBuilder(path, caption, mentions)
+    builder.width, builder.height = _PresetClip.preset.width, _PresetClip.preset.height
+    build = builder.photo(max_duration) if kind == 'photo' else builder.video(max_duration)
+    return str(build.path)
+
+
+def render_key(kind: str, digest: str, caption: str, mentions: List, max_duration: int, preset: str) -> str:
+    """Hash of everything that changes the rendered video
+    """
+    raw = json.dumps([kind, digest, caption, jsonable_encoder(mentions), max_duration, preset], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class Renderer:
+    """Run StoryBuilder jobs in a bounded process pool, rendered videos are cached by render_key
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, cache: Optional[MediaCache] = None):
+        self.workers = workers
+        self.cache = cache or MediaCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES)
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(RENDER_START_METHOD))
+        return self._pool
+
+    async def render(self, kind: str, path: str, caption: str = '', mentions: Optional[List] = None,
+                     max_duration: int = 15, preset: str = RENDER_PRESET) -> CachedFile:
+        """Rendered story video for a photo or video file, from cache when the same input was rendered before
+        """
+        if preset not in RENDER_PRESETS:
+            raise ValueError(f'Unknown render preset "{preset}", expected one of {", ".join(RENDER_PRESETS)}')
+        mentions = mentions or []
+        digest = await run_in_threadpool(file_digest, path)
+        key = render_key(kind, digest, caption, mentions, max_duration, preset)
+        blob = await run_in_threadpool(self.cache.get, key, preset)
+        if blob is not None:
+            return blob
+
+        async def fetch():
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(self.pool, _render, kind, path, caption, mentions, max_duration, preset)
+            return await run_in_threadpool(self.cache.put_file, key, preset, output)
+
+        return await flights.do(('render', key), fetch)
+
+    @asynccontextmanager
+    async def rendered(self, kind: str, path: str, caption: str = '', mentions: Optional[List] = None,
+                       max_duration: int = 15, preset: str = RENDER_PRESET) -> AsyncIterator[str]:
+        """Private link to the rendered video, so cache eviction can't remove it while in use
+        """
+        blob = await self.render(kind, path, caption, mentions, max_duration, preset)
+        folder = self.cache.tmp_folder()
+        try:
+            link = os.path.join(folder, os.path.basename(blob.path))
+            os.link(blob.path, link)
+            yield link
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def stats(self) -> Dict:
+        return dict(self.cache.stats(), workers=self.workers)
+
+
+renderer = Renderer()
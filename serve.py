@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote_plus
+
+import httpx
+import uvicorn
+
+from storages import SESSION_STORE, session_key
+
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', os.environ.get('WEB_CONCURRENCY', 1)))
+SERVE_SOCKET_DIR = os.environ.get('SERVE_SOCKET_DIR', '')
+SERVE_PEEK_BYTES = int(os.environ.get('SERVE_PEEK_BYTES', 64 * 1024))
+SERVE_START_TIMEOUT = float(os.environ.get('SERVE_START_TIMEOUT', 60))
+SERVE_RESTART_DELAY = float(os.environ.get('SERVE_RESTART_DELAY', 1))
+SERVE_PURGE_INTERVAL = float(os.environ.get('SERVE_PURGE_INTERVAL', 300))
+SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB') or './shared.sqlite3'
+
+logger = logging.getLogger(__name__)
+
+HOP_HEADERS = {b'connection', b'keep-alive', b'proxy-connection', b'te', b'trailer', b'transfer-encoding',
+               b'upgrade'}
+OWN_HEADERS = {b'date', b'server'}  # set again by the router's uvicorn
+FORM_SESSIONID = re.compile(rb'(?:^|&)sessionid=([^&]*)')
+MULTIPART_SESSIONID = re.compile(rb'name="sessionid"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', re.DOTALL)
+
+
+def find_sessionid(query_string: bytes, content_type: bytes, body: bytes) -> Optional[str]:
+    """sessionid of a request from its query string or the start of its form body
+    """
+    values = parse_qs(query_string.decode('latin-1')).get('sessionid')
+    if values:
+        return values[0]
+    if content_type.startswith(b'application/x-www-form-urlencoded'):
+        match = FORM_SESSIONID.search(body)
+        return unquote_plus(match.group(1).decode('latin-1')) if match else None
+    if content_type.startswith(b'multipart/form-data'):
+        match = MULTIPART_SESSIONID.search(body)
+        return match.group(1).decode('latin-1') if match else None
+    return None
+
+
+class Worker:
+    """uvicorn process serving main:app on a unix socket
+    """
+
+    def __init__(self, index: int, socket: str, root_path: str = ''):
+        self.index = index
+        self.socket = socket
+        self.root_path = root_path
+        self.process: Optional[subprocess.Popen] = None
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def start(self):
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        env = dict(os.environ, SHARED_STATE_DB=SHARED_STATE_DB, WORKER_INDEX=str(self.index))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--uds', self.socket, '--root-path', self.root_path],
+            env=env)
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None and os.path.exists(self.socket)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class AffinityRouter:
+    """ASGI front of serve.py: forward every request to a worker process
+
+    Requests of one sessionid always go to the same worker (crc32 of the
+    session key), so its warm Client, serialized calls and validation state
+    stay in one process; the next live worker takes over while it restarts.
+    The sessionid is looked up in the query string and in the first
+    peek_bytes of form bodies, requests without one are spread round-robin.
+    Bodies and responses are streamed.
+    """
+
+    def __init__(self, workers: List[Worker], peek_bytes: int = SERVE_PEEK_BYTES, shared=None):
+        self.workers = workers
+        self.peek_bytes = peek_bytes
+        self.shared = shared
+        self._round_robin = itertools.cycle(range(len(workers)))
+        self._supervisor: Optional[asyncio.Future] = None
+
+    def pick(self, sessionid: Optional[str]) -> Optional[Worker]:
+        if sessionid:
+            first = zlib.crc32(session_key(sessionid).encode()) % len(self.workers)
+        else:
+            first = next(self._round_robin)
+        for offset in range(len(self.workers)):
+            worker = self.workers[(first + offset) % len(self.workers)]
+            if worker.alive:
+                return worker
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.forward(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                for worker in self.workers:
+                    worker.start()
+                    worker.client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=worker.socket),
+                                                      base_url='http://worker', timeout=None)
+                deadline = time.monotonic() + SERVE_START_TIMEOUT
+                while not all(worker.alive for worker in self.workers) and time.monotonic() < deadline:
+                    await asyncio.sleep(0.1)
+                self._supervisor = asyncio.ensure_future(self.supervise())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._supervisor.cancel()
+                for worker in self.workers:
+                    worker.stop()
+                    await worker.client.aclose()
+                for worker in self.workers:
+                    if worker.process is not None:
+                        await asyncio.get_event_loop().run_in_executor(None, worker.process.wait)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def supervise(self):
+        """Restart exited workers, purge expired shared state now and then
+        """
+        purged = time.monotonic()
+        while True:
+            await asyncio.sleep(SERVE_RESTART_DELAY)
+            for worker in self.workers:
+                if worker.process.poll() is not None:
+                    logger.warning('Worker %d exited with %s, restarting', worker.index, worker.process.returncode)
+                    worker.start()
+            if self.shared is not None and time.monotonic() - purged > SERVE_PURGE_INTERVAL:
+                purged = time.monotonic()
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, self.shared.purge)
+                except Exception as e:
+                    logger.warning('Purge of shared state failed: %r', e)
+
+    async def peek(self, scope, receive) -> Tuple[bytes, bool]:
+        """Read the start of the body: (prefix, more_body)
+        """
+        if scope['method'] in ('GET', 'HEAD', 'DELETE', 'OPTIONS'):
+            return b'', False
+        prefix = b''
+        more_body = True
+        while more_body and len(prefix) < self.peek_bytes:
+            message = await receive()
+            prefix += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return prefix, more_body
+
+    async def forward(self, scope, receive, send):
+        headers = [(name, value) for name, value in scope['headers'] if name not in HOP_HEADERS]
+        content_type = dict(headers).get(b'content-type', b'')
+        prefix, more_body = await self.peek(scope, receive)
+        worker = self.pick(find_sessionid(scope['query_string'], content_type, prefix))
+        if worker is None:
+            await self.respond_error(send, 503, 'No worker is running, retry later')
+            return
+
+        async def body() -> AsyncIterator[bytes]:
+            yield prefix
+            nonlocal more_body
+            while more_body:
+                message = await receive()
+                yield message.get('body', b'')
+                more_body = message.get('more_body', False)
+
+        url = scope.get('raw_path') or scope['path'].encode()
+        if scope['query_string']:
+            url += b'?' + scope['query_string']
+        request = worker.client.build_request(scope['method'], url.decode('latin-1'), headers=headers,
+                                              content=body() if more_body else prefix)
+        try:
+            response = await worker.client.send(request, stream=True, allow_redirects=False)
+        except httpx.TransportError as e:
+            logger.warning('Worker %d failed: %r', worker.index, e)
+            await self.respond_error(send, 502, f'Worker {worker.index} failed, retry later')
+            return
+        headers = [(name, value) for name, value in response.headers.raw
+                   if name.lower() not in HOP_HEADERS and name.lower() not in OWN_HEADERS]
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': headers + [(b'x-worker', str(worker.index).encode())],
+            })
+            async for chunk in response.aiter_raw():
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await response.aclose()
+
+    async def respond_error(self, send, status: int, detail: str):
+        body = ('{"detail": "%s"}' % detail).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Serve main:app with several worker processes')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=SERVE_WORKERS)
+    parser.add_argument('--root-path', default='')
+    args = parser.parse_args(argv)
+    if args.workers <= 1:
+        uvicorn.run('main:app', host=args.host, port=args.port, root_path=args.root_path)
+        return
+    if SESSION_STORE == 'tinydb':
+        parser.error('SESSION_STORE=tinydb cannot be shared between workers, use sqlite')
+
+    from shared import SharedState
+    shared = SharedState(SHARED_STATE_DB)
+    socket_dir = SERVE_SOCKET_DIR or tempfile.mkdtemp(prefix='instagrapi-rest-')
+    os.makedirs(socket_dir, exist_ok=True)
+    workers = [Worker(i, os.path.join(socket_dir, f'worker-{i}.sock'), args.root_path) for i in range(args.workers)]
+    try:
+        uvicorn.run(AffinityRouter(workers, shared=shared), host=args.host, port=args.port,
+                    root_path=args.root_path, lifespan='on')
+    finally:
+        if not SERVE_SOCKET_DIR:
+            shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
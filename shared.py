@@ -0,0 +1,77 @@
+import os
+import pickle
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from storages import SQLiteStore
+
+SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB', '')
+
+
+class SharedState(SQLiteStore):
+    """Pickled key/value state shared by the worker processes of serve.py
+
+    Serves as second-level response cache and holds the rate limit buckets,
+    so every worker paces the same proxy against the same budget. Entries
+    with expires_at 0 never expire.
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS shared ('
+        'key TEXT PRIMARY KEY, '
+        'value BLOB NOT NULL, '
+        'expires_at REAL NOT NULL DEFAULT 0)',
+    )
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._connection().execute(
+            'SELECT value FROM shared WHERE key = ? AND (expires_at = 0 OR expires_at > ?)', (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float = 0):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO shared (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, pickle.dumps(value), time.time() + ttl if ttl else 0))
+
+    def update(self, keys: Iterable[str], fn: Callable[[Dict[str, Any]], Tuple[Dict[str, Any], Any]],
+               ttl: float = 0) -> Any:
+        """Read keys, store what fn(values) returns and return its result, all in one write transaction
+
+        Missing or expired keys are absent from values.
+        """
+        keys = list(keys)
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            rows = conn.execute(
+                'SELECT key, value FROM shared WHERE key IN (%s) AND (expires_at = 0 OR expires_at > ?)'
+                % ','.join('?' * len(keys)), keys + [now]
+            ).fetchall()
+            values, result = fn({key: pickle.loads(value) for key, value in rows})
+            conn.executemany(
+                'INSERT OR REPLACE INTO shared (key, value, expires_at) VALUES (?, ?, ?)',
+                [(key, pickle.dumps(value), now + ttl if ttl else 0) for key, value in values.items()]
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return result
+
+    def items(self, prefix: str) -> List[Tuple[str, Any]]:
+        rows = self._connection().execute(
+            'SELECT key, value FROM shared WHERE key >= ? AND key < ? AND (expires_at = 0 OR expires_at > ?)',
+            (prefix, prefix + '￿', time.time())
+        ).fetchall()
+        return [(key, pickle.loads(value)) for key, value in rows]
+
+    def purge(self) -> int:
+        """Remove expired entries
+        """
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM shared WHERE expires_at != 0 AND expires_at <= ?',
+                                (time.time(),)).rowcount
+
+
+shared_state = SharedState(SHARED_STATE_DB) if SHARED_STATE_DB else None
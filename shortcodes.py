@@ -0,0 +1,103 @@
+import base64
+import binascii
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import urlparse
+
+# Shortcodes are base64 (url-safe alphabet) of the media pk without leading "A" (zero) digits.
+# 12 chars = 9 bytes = 72 bits, enough for any 64-bit pk and the 11-char code prefix.
+CODE_WIDTH = 12
+PK_BYTES = 9
+
+
+def pk_from_code(code: str) -> int:
+    """Get media pk from code (aka shortcode), no Client needed
+
+    B1LbfVPlwIA -> 2110901750722920960
+    """
+    code = code[:11]
+    if not code:
+        raise ValueError('Empty media code')
+    try:
+        raw = base64.b64decode(code.rjust(CODE_WIDTH, 'A'), altchars=b'-_', validate=True)
+    except binascii.Error:
+        raise ValueError(f'Invalid media code "{code}"')
+    return int.from_bytes(raw, 'big')
+
+
+def code_from_pk(pk: int) -> str:
+    """Get media code from pk
+
+    2110901750722920960 -> B1LbfVPlwIA
+    """
+    pk = int(pk)
+    if pk <= 0 or pk.bit_length() > PK_BYTES * 8:
+        raise ValueError(f'Invalid media pk "{pk}"')
+    return base64.b64encode(pk.to_bytes(PK_BYTES, 'big'), altchars=b'-_').decode().lstrip('A')
+
+
+def code_from_url(url: str) -> str:
+    """Get media code from URL (last path part)
+
+    https://www.instagram.com/p/B-fKL9qpeab/?igshid=1xm76zkq7o1im -> B-fKL9qpeab
+    """
+    parts = [p for p in urlparse(url).path.split('/') if p]
+    if not parts:
+        raise ValueError(f'No media code in URL "{url}"')
+    return parts[-1]
+
+
+def pk_from_url(url: str) -> int:
+    """Get media pk from URL
+    """
+    return pk_from_code(code_from_url(url))
+
+
+def pks_from_codes(codes: Iterable[str]) -> Tuple[Dict[str, int], Dict[str, str]]:
+    """Convert many codes at once: (results, errors)
+
+    Valid input is decoded with one base64 call over the joined codes,
+    a bad code only sends that item through the per-item path.
+    """
+    codes = list(dict.fromkeys(codes))
+    prefixes = [code[:11].rjust(CODE_WIDTH, 'A') for code in codes]
+    try:
+        if not all(codes):
+            raise ValueError('Empty media code')
+        raw = base64.b64decode(''.join(prefixes), altchars=b'-_', validate=True)
+    except (binascii.Error, ValueError):
+        return _convert_each(codes, pk_from_code)
+    results = {
+        code: int.from_bytes(raw[i:i + PK_BYTES], 'big')
+        for code, i in zip(codes, range(0, len(raw), PK_BYTES))
+    }
+    return results, {}
+
+
+def codes_from_pks(pks: Iterable[int]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Convert many pks at once: (results, errors)
+    """
+    return _convert_each(list(dict.fromkeys(str(pk) for pk in pks)), code_from_pk)
+
+
+def pks_from_urls(urls: Iterable[str]) -> Tuple[Dict[str, int], Dict[str, str]]:
+    """Convert many URLs at once: (results, errors)
+    """
+    codes, errors = _convert_each(list(dict.fromkeys(urls)), code_from_url)
+    pks, code_errors = pks_from_codes(codes.values())
+    results = {}
+    for url, code in codes.items():
+        if code in pks:
+            results[url] = pks[code]
+        else:
+            errors[url] = code_errors[code]
+    return results, errors
+
+
+def _convert_each(items: List, convert) -> Tuple[Dict, Dict[str, str]]:
+    results, errors = {}, {}
+    for item in items:
+        try:
+            results[item] = convert(item)
+        except ValueError as e:
+            errors[item] = str(e)
+    return results, errors
@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from instagrapi import Client
+from starlette.concurrency import run_in_threadpool
+
+from pages import Pager, followers_page, following_page
+from storages import SESSION_DB, SQLiteStore
+
+SNAPSHOT_DB = os.environ.get('SNAPSHOT_DB', SESSION_DB)
+SNAPSHOT_KNOWN_PAGES = int(os.environ.get('SNAPSHOT_KNOWN_PAGES', 2))
+SNAPSHOT_FULL_INTERVAL = float(os.environ.get('SNAPSHOT_FULL_INTERVAL', 24 * 3600))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 0))  # per account and kind, 0 keeps all
+
+SNAPSHOT_PAGES = {'followers': followers_page, 'following': following_page}
+
+
+def encode_pks(pks: array) -> bytes:
+    """Sorted int64 pks as little-endian bytes (8 bytes per pk)
+    """
+    if sys.byteorder == 'big':
+        pks = array('q', pks)
+        pks.byteswap()
+    return pks.tobytes()
+
+
+def decode_pks(blob: bytes) -> array:
+    pks = array('q')
+    pks.frombytes(blob)
+    if sys.byteorder == 'big':
+        pks.byteswap()
+    return pks
+
+
+def contains(pks: array, pk: int) -> bool:
+    index = bisect_left(pks, pk)
+    return index < len(pks) and pks[index] == pk
+
+
+def union(pks: array, other: Iterable[int]) -> array:
+    """Sorted union of sorted pks and sorted other
+    """
+    result = array('q')
+    last = None
+    for pk in merge(pks, other):
+        if pk != last:
+            result.append(pk)
+            last = pk
+    return result
+
+
+def diff(old: array, new: array) -> Tuple[array, array]:
+    """(added, removed) pks between two sorted arrays, in one merge pass
+    """
+    added, removed = array('q'), array('q')
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
+
+
+class Snapshot(NamedTuple):
+    id: int
+    user_id: str
+    kind: str
+    taken_at: float
+    count: int
+    complete: bool  # False: the sync stopped at a known region, removals there are not seen
+    pks: array
+
+    def info(self) -> Dict:
+        return {'id': self.id, 'user_id': self.user_id, 'kind': self.kind, 'taken_at': self.taken_at,
+                'count': self.count, 'complete': self.complete}
+
+
+class SnapshotStore(SQLiteStore):
+    """Follower/following snapshots of accounts as sorted int64 pk blobs, in the session database by default
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS snapshots ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'user_id TEXT NOT NULL, '
+        'kind TEXT NOT NULL, '
+        'taken_at REAL NOT NULL, '
+        'count INTEGER NOT NULL, '
+        'complete INTEGER NOT NULL, '
+        'pks BLOB NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS snapshots_account ON snapshots (user_id, kind, taken_at)',
+    )
+    columns = ('id', 'user_id', 'kind', 'taken_at', 'count', 'complete')
+
+    def add(self, user_id: str, kind: str, pks: array, complete: bool, keep: int = SNAPSHOT_KEEP) -> Snapshot:
+        """Store sorted pks as the newest snapshot, drop all but the keep newest ones of the account
+        """
+        taken_at = time.time()
+        with self._connection() as conn:
+            snapshot_id = conn.execute(
+                'INSERT INTO snapshots (user_id, kind, taken_at, count, complete, pks) VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, kind, taken_at, len(pks), int(complete), encode_pks(pks))
+            ).lastrowid
+            if keep:
+                conn.execute(
+                    'DELETE FROM snapshots WHERE user_id = ? AND kind = ? AND id NOT IN ('
+                    'SELECT id FROM snapshots WHERE user_id = ? AND kind = ? ORDER BY taken_at DESC LIMIT ?)',
+                    (user_id, kind, user_id, kind, keep)
+                )
+        return Snapshot(snapshot_id, user_id, kind, taken_at, len(pks), complete, pks)
+
+    def _snapshot(self, row) -> Optional[Snapshot]:
+        if row is None:
+            return None
+        *info, complete, blob = row
+        return Snapshot(*info, bool(complete), decode_pks(blob))
+
+    def get(self, snapshot_id: int) -> Optional[Snapshot]:
+        return self._snapshot(self._connection().execute(
+            f'SELECT {", ".join(self.columns)}, pks FROM snapshots WHERE id = ?', (snapshot_id,)
+        ).fetchone())
+
+    def latest(self, user_id: str, kind: str) -> Optional[Snapshot]:
+        return self._snapshot(self._connection().execute(
+            f'SELECT {", ".join(self.columns)}, pks FROM snapshots WHERE user_id = ? AND kind = ? '
+            'ORDER BY taken_at DESC LIMIT 1', (user_id, kind)
+        ).fetchone())
+
+    def last_complete(self, user_id: str, kind: str) -> Optional[float]:
+        """When the account was last synced with a full pass
+        """
+        row = self._connection().execute(
+            'SELECT MAX(taken_at) FROM snapshots WHERE user_id = ? AND kind = ? AND complete = 1', (user_id, kind)
+        ).fetchone()
+        return row[0]
+
+    def list(self, user_id: str, kind: str) -> List[Dict]:
+        """Snapshots of the account without their pks, newest first
+        """
+        rows = self._connection().execute(
+            f'SELECT {", ".join(self.columns)} FROM snapshots WHERE user_id = ? AND kind = ? '
+            'ORDER BY taken_at DESC', (user_id, kind)
+        ).fetchall()
+        return [dict(zip(self.columns, row[:-1]), complete=bool(row[-1])) for row in rows]
+
+
+async def sync(sessionid: str, cl: Client, user_id: str, kind: str, full: bool = False,
+               store: Optional[SnapshotStore] = None) -> Dict:
+    """Take a new snapshot of the account's followers or following
+
+    The lists come newest first. Once SNAPSHOT_KNOWN_PAGES pages in a row
+    hold only pks of the previous snapshot, paging stops and the rest of the
+    previous snapshot is carried over, so removals are only seen by full
+    passes. The first sync, full=True and syncs more than
+    SNAPSHOT_FULL_INTERVAL after the last full pass read the whole list.
+    """
+    if kind not in SNAPSHOT_PAGES:
+        raise ValueError(f'Unknown snapshot kind "{kind}", expected one of {", ".join(SNAPSHOT_PAGES)}')
+    store = store or snapshots
+    previous = await run_in_threadpool(store.latest, user_id, kind)
+    if previous is not None and not full:
+        last_complete = await run_in_threadpool(store.last_complete, user_id, kind)
+        full = last_complete is None or time.time() - last_complete > SNAPSHOT_FULL_INTERVAL
+    seen = set()
+    known_pages = pages = 0
+    complete = True
+    iterator = Pager(sessionid, cl, SNAPSHOT_PAGES[kind], user_id).__aiter__()
+    try:
+        async for items in iterator:
+            pages += 1
+            pks = [int(user.pk) for user in items]
+            seen.update(pks)
+            if previous is None or full:
+                continue
+            known_pages = known_pages + 1 if all(contains(previous.pks, pk) for pk in pks) else 0
+            if known_pages >= SNAPSHOT_KNOWN_PAGES:
+                complete = False
+                break
+    finally:
+        await iterator.aclose()
+    pks = array('q', sorted(seen))
+    if not complete:
+        pks = union(previous.pks, pks)
+    snapshot = await run_in_threadpool(store.add, user_id, kind, pks, complete)
+    added, removed = diff(previous.pks, pks) if previous is not None else (pks, array('q'))
+    return dict(snapshot.info(), pages=pages, previous_id=previous.id if previous else None,
+                added=len(added), removed=len(removed))
+
+
+snapshots = SnapshotStore(SNAPSHOT_DB)
@@ -1,42 +1,243 @@
+import argparse
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import threading
+import time
 from urllib import parse
 from instagrapi import Client
 from tinydb import TinyDB, Query
 import json
+from typing import Dict, Iterable, Optional, Tuple
+
+from metrics import session_lookup_latency
+from pools import ClientPool
+from profiling import record_phase
+from proxies import ProxyPool, proxy_pool
+from validation import SessionValidator
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'sqlite')
+SESSION_DB = os.environ.get('SESSION_DB', './sessions.sqlite3')
+
+
+class SessionStore(ABC):
+    """Session settings backend (keyed by sessionid)
+    """
+
+    @abstractmethod
+    def get(self, sessionid: str) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    def set(self, sessionid: str, settings: Dict):
+        pass
+
+    def set_many(self, items: Iterable[Tuple[str, Dict]]) -> int:
+        count = 0
+        for sessionid, settings in items:
+            self.set(sessionid, settings)
+            count += 1
+        return count
+
+    @abstractmethod
+    def delete(self, sessionid: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class TinyDBSessionStore(SessionStore):
+    """Legacy single-file JSON store (linear scan, kept for compatibility)
+    """
+
+    def __init__(self, path: str = './db.json'):
+        self.db = TinyDB(path)
+
+    def get(self, sessionid: str) -> Optional[Dict]:
+        rows = self.db.search(Query().sessionid == sessionid)
+        if not rows:
+            return None
+        return json.loads(rows[-1]['settings'])
+
+    def set(self, sessionid: str, settings: Dict):
+        self.db.upsert({'sessionid': sessionid, 'settings': json.dumps(settings)},
+                       Query().sessionid == sessionid)
+
+    def delete(self, sessionid: str):
+        self.db.remove(Query().sessionid == sessionid)
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStore:
+    """SQLite file in WAL mode, one connection per thread
+
+    Safe to share the file between worker processes.
+    """
+    schema: Tuple[str, ...] = ()
+
+    def __init__(self, path: str = SESSION_DB, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            for statement in self.schema:
+                conn.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SQLiteSessionStore(SQLiteStore, SessionStore):
+    """SQLite store in WAL mode with sessionid primary key
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS sessions ('
+        'sessionid TEXT PRIMARY KEY, '
+        'settings TEXT NOT NULL, '
+        'updated_at REAL NOT NULL)',
+    )
+
+    def get(self, sessionid: str) -> Optional[Dict]:
+        row = self._connection().execute(
+            'SELECT settings FROM sessions WHERE sessionid = ?', (sessionid,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, sessionid: str, settings: Dict):
+        self.set_many([(sessionid, settings)])
+
+    def set_many(self, items: Iterable[Tuple[str, Dict]]) -> int:
+        now = time.time()
+        rows = [(sessionid, json.dumps(settings), now) for sessionid, settings in items]
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT INTO sessions (sessionid, settings, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(sessionid) DO UPDATE SET '
+                'settings = excluded.settings, updated_at = excluded.updated_at',
+                rows
+            )
+        return len(rows)
+
+    def delete(self, sessionid: str):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE sessionid = ?', (sessionid,))
+
+
+def session_key(sessionid: str) -> str:
+    """Normalize sessionid as it comes from forms and cookies
+    """
+    return parse.unquote(sessionid.strip(" \""))
+
+
+def session_store(backend: str = SESSION_STORE) -> SessionStore:
+    """Build session store by SESSION_STORE name
+    """
+    if backend == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB)
+    if backend == 'tinydb':
+        return TinyDBSessionStore()
+    raise ValueError(f'Unknown session store "{backend}"')
+
+
+def migrate_tinydb(path: str, store: SessionStore) -> int:
+    """Copy sessions from TinyDB json file to store (latest row per sessionid wins)
+    """
+    db = TinyDB(path)
+    try:
+        sessions = {}
+        for row in db.all():
+            sessions[row['sessionid']] = json.loads(row['settings'])
+    finally:
+        db.close()
+    return store.set_many(sessions.items())
 
 
 class ClientStorage:
-    db = TinyDB('./db.json')
+    db = session_store()
+    pool = ClientPool()
+    validator = SessionValidator()
+    proxies: ProxyPool = proxy_pool
 
     def client(self):
         """Get new client (helper)
         """
-        cl = Client()
+        cl = self.proxies.mount(Client())
         cl.request_timeout = 0.1
         return cl
 
     def get(self, sessionid: str, proxy: str | None = None) -> Client:
-        """Get client settings
+        """Get client settings (proxy="group:NAME" picks a healthy proxy of the group)
         """
-        key = parse.unquote(sessionid.strip(" \""))
-        try:
-            settings = json.loads(self.db.search(Query().sessionid == key)[0]['settings'])
-            if proxy:
-                cl = Client(proxy=proxy)
-            else:
-                cl = Client()
-            cl.set_settings(settings)
-            cl.get_timeline_feed()
-            return cl
-        except IndexError:
+        key = session_key(sessionid)
+        proxy = self.proxies.resolve(proxy, key)
+        cl = self.pool.get((key, proxy or ''))
+        if cl is None:
+            cl = self.build(key, proxy)
+            self.pool.put((key, proxy or ''), cl)
+        self.validator.touch(key, lambda: self.build(key, proxy))
+        return cl
+
+    def build(self, key: str, proxy: Optional[str] = None) -> Client:
+        """Build new client from stored settings (no upstream requests)
+        """
+        started = time.perf_counter()
+        with session_lookup_latency.time(type(self.db).__name__):
+            settings = self.db.get(key)
+        record_phase('session_lookup', time.perf_counter() - started)
+        if settings is None:
             raise Exception('Session not found (e.g. after reload process), please relogin')
+        if proxy:
+            cl = Client(proxy=proxy)
+        else:
+            cl = Client()
+        cl.set_settings(settings)
+        return self.proxies.mount(cl)
+
+    @classmethod
+    def invalidate(cls, sessionid: str, exc: Exception, proxy: Optional[str] = None):
+        """Forget warm clients of a session that failed upstream and re-check it
+        """
+        key = session_key(sessionid)
+        cls.validator.mark_invalid(key, exc)
+        cls.pool.discard(key)
+        cls.validator.check_in_background(key, lambda: cls().build(key, proxy))
 
     def set(self, cl: Client) -> bool:
         """Set client settings
         """
-        key = parse.unquote(cl.sessionid.strip(" \""))
-        self.db.insert({'sessionid': key, 'settings': json.dumps(cl.get_settings())})
+        key = session_key(cl.sessionid)
+        self.db.set(key, cl.get_settings())
+        self.validator.mark_valid(key)
+        self.pool.discard(key)
+        self.pool.put((key, cl.proxy or ''), cl)
         return True
 
     def close(self):
         pass
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate sessions from TinyDB db.json to the session store')
+    parser.add_argument('source', nargs='?', default='./db.json')
+    parser.add_argument('--backend', default=SESSION_STORE)
+    args = parser.parse_args()
+    count = migrate_tinydb(args.source, session_store(args.backend))
+    print(f'Migrated {count} sessions from {args.source}')
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from instagrapi import Client
+from instagrapi.exceptions import (
+    ChallengeError, ClientLoginRequired, LoginRequired, ReloginAttemptExceeded
+)
+
+from metrics import upstream_latency
+
+SESSION_VALID_TTL = float(os.environ.get('SESSION_VALID_TTL', 3600))
+SESSION_CHECK_WORKERS = int(os.environ.get('SESSION_CHECK_WORKERS', 2))
+
+LOGIN_ERRORS = (LoginRequired, ClientLoginRequired, ChallengeError, ReloginAttemptExceeded)
+
+
+class SessionValidator:
+    """Cached session validity, checked lazily in background threads
+
+    A session is trusted for `ttl` seconds after a successful check. Expired
+    or unknown sessions are re-checked in the background on the next lookup,
+    sessions that failed upstream with a login/challenge error are marked
+    invalid and re-checked right away.
+    """
+
+    def __init__(self, ttl: float = SESSION_VALID_TTL, workers: int = SESSION_CHECK_WORKERS):
+        self.ttl = ttl
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='session-check')
+        self._states: Dict[str, Dict] = {}
+        self._checking = set()
+        self._lock = threading.Lock()
+
+    def status(self, key: str) -> Dict:
+        """Get validity state of session
+        """
+        with self._lock:
+            state = dict(self._states.get(key) or {'state': 'unknown', 'checked_at': None,
+                                                  'valid_until': None, 'error': None})
+            if state['state'] == 'valid' and state['valid_until'] < time.time():
+                state['state'] = 'expired'
+            state['checking'] = key in self._checking
+        return state
+
+    def mark_valid(self, key: str):
+        now = time.time()
+        with self._lock:
+            self._states[key] = {'state': 'valid', 'checked_at': now,
+                                 'valid_until': now + self.ttl, 'error': None}
+
+    def mark_invalid(self, key: str, exc: Exception):
+        with self._lock:
+            self._states[key] = {'state': 'invalid', 'checked_at': time.time(),
+                                 'valid_until': None, 'error': f'{type(exc).__name__}: {exc}'}
+
+    def check(self, key: str, build: Callable[[], Client]) -> bool:
+        """Check session by timeline request (blocking)
+        """
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            build().get_timeline_feed()
+            outcome = 'ok'
+        except LOGIN_ERRORS as e:
+            self.mark_invalid(key, e)
+            return False
+        except Exception as e:
+            with self._lock:
+                state = self._states.setdefault(key, {'state': 'unknown', 'checked_at': None,
+                                                      'valid_until': None, 'error': None})
+                state['error'] = f'{type(e).__name__}: {e}'
+            return False
+        finally:
+            upstream_latency.observe(time.perf_counter() - started, 'get_timeline_feed', outcome)
+            with self._lock:
+                self._checking.discard(key)
+        self.mark_valid(key)
+        return True
+
+    def check_in_background(self, key: str, build: Callable[[], Client]):
+        """Schedule check unless one is already running for key
+        """
+        with self._lock:
+            if key in self._checking:
+                return
+            self._checking.add(key)
+        self.pool.submit(self.check, key, build)
+
+    def touch(self, key: str, build: Callable[[], Client]):
+        """Schedule background check if validity is unknown or expired
+
+        Invalid sessions are only re-checked after the next upstream failure.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state and (state['state'] == 'invalid' or state['valid_until'] and state['valid_until'] >= time.time()):
+                return
+        self.check_in_background(key, build)